@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class AccessTokenManager:
+    """Токен доступа к магазину, который обновляется заранее.
+
+    Токен хранится в памяти процесса вместе с настоящим временем
+    истечения из ответа OAuth и обновляется фоновым таймером за
+    `refresh_margin` секунд до истечения. Несколько копий бота делят
+    токен через Redis, а обновляет его только та, что взяла блокировку.
+    """
+
+    def __init__(self, fetch_token, database: redis.Redis = None,
+                 refresh_margin: int = 300, default_lifetime: int = 3600,
+                 key: str = 'store_access_token'):
+        self._fetch_token = fetch_token
+        self._database = database
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self._key = key
+        self._token = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _is_valid(self, margin: float = 0) -> bool:
+        return bool(self._token) and time.time() < self._expires - margin
+
+    def get(self) -> str:
+        if self._is_valid():
+            return self._token
+        return self.refresh()
+
+    def refresh(self, stale_token: str = None) -> str:
+        with self._lock:
+            if self._token != stale_token and self._is_valid():
+                return self._token
+            token, expires = self._load_shared(stale_token)
+            if not token:
+                token, expires = self._refresh_shared(stale_token)
+            self._set(token, expires)
+            return token
+
+    def _set(self, token: str, expires: float) -> None:
+        self._token, self._expires = token, expires
+        if self._timer:
+            self._timer.cancel()
+        delay = max(expires - self.refresh_margin - time.time(), 1)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self) -> None:
+        try:
+            with self._lock:
+                token, expires = self._load_shared(self._token)
+                if not token:
+                    token, expires = self._refresh_shared(self._token)
+                self._set(token, expires)
+        except Exception as err:
+            logger.warning(f'Не удалось обновить токен доступа\n{err}\n')
+            self._timer = threading.Timer(10, self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fetch(self) -> tuple[str, float]:
+        access_token = self._fetch_token()
+        token = access_token.get('access_token')
+        expires = access_token.get('expires') \
+            or time.time() + self.default_lifetime
+        return token, float(expires)
+
+    def _load_shared(self, stale_token: str = None) -> tuple[str, float]:
+        if self._database is None:
+            return None, 0.0
+        pipeline = self._database.pipeline()
+        pipeline.get(self._key)
+        pipeline.ttl(self._key)
+        token, ttl = pipeline.execute()
+        if not token or ttl <= self.refresh_margin:
+            return None, 0.0
+        token = token.decode('utf-8')
+        if token == stale_token:
+            return None, 0.0
+        return token, time.time() + ttl
+
+    def _refresh_shared(self, stale_token: str = None) -> tuple[str, float]:
+        if self._database is None:
+            return self._fetch()
+        lock = self._database.lock(f'{self._key}_lock', timeout=30,
+                                   blocking_timeout=15)
+        if not lock.acquire():
+            token, expires = self._load_shared(stale_token)
+            if token:
+                return token, expires
+            return self._fetch()
+        try:
+            token, expires = self._load_shared(stale_token)
+            if token:
+                return token, expires
+            token, expires = self._fetch()
+            ttl = int(expires - time.time())
+            if ttl > 0:
+                self._database.setex(self._key, ttl, token)
+            return token, expires
+        finally:
+            lock.release()
@@ -0,0 +1,422 @@
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from urllib.parse import parse_qs, urlsplit
+
+from environs import Env
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, Dispatcher, JobQueue
+
+import bot
+import metrics
+import moltin_api
+from fake_telegram import make_callback_update, make_message_update
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+logger = logging.getLogger(__name__)
+
+FAKE_TG_TOKEN = '123456:' + 'A' * 35
+CART_ITEMS_PATTERN = re.compile(r'^/v2/carts/(\d+)/items(?:/([^/]+))?$')
+INVENTORY_PATTERN = re.compile(r'^/v2/inventories/([^/]+)$')
+FILE_PATTERN = re.compile(r'^/v2/files/([^/]+)$')
+CATEGORY_NAMES = ('Красная рыба', 'Белая рыба', 'Морепродукты')
+
+
+class FakeElasticpath:
+    """Заглушка api.moltin.com с каталогом из `products` товаров.
+
+    Каждый ответ задерживается на `latency` секунд, а доля `error_rate`
+    ответов — ошибки 503. Обращения считаются по адресам.
+    """
+
+    def __init__(self, products: int, latency: float, error_rate: float,
+                 page_limit: int = 100):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_limit = page_limit
+        self.categories = [{'id': f'category-{number}', 'type': 'category',
+                            'name': name}
+                           for number, name in enumerate(CATEGORY_NAMES)]
+        self.products = [self._make_product(number)
+                         for number in range(products)]
+        self.products_by_id = {product['id']: product
+                               for product in self.products}
+        self.carts = defaultdict(dict)
+        self.calls = Counter()
+        self.errors = 0
+        self.base_url = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_product(number: int) -> dict:
+        return {
+            'id': f'product-{number}',
+            'attributes': {
+                'name': f'Рыба {number}',
+                'description': f'Свежая рыба номер {number}',
+                'price': {'USD': {'amount': 1000 + number}},
+            },
+            'relationships': {
+                'main_image': {'data': {'id': f'image-{number}'}},
+                'categories': {'data': [{
+                    'type': 'category',
+                    'id': f'category-{number % len(CATEGORY_NAMES)}',
+                }]},
+            },
+        }
+
+    def _page(self, records: list, query: dict) -> dict:
+        limit = int(query.get('page[limit]', [self.page_limit])[0])
+        offset = int(query.get('page[offset]', [0])[0])
+        return {'data': records[offset:offset + limit],
+                'meta': {'results': {'total': len(records)}}}
+
+    def _cart(self, chat_id: str) -> dict:
+        items = []
+        total = 0
+        for product_id, quantity in self.carts[chat_id].items():
+            product = self.products_by_id[product_id]
+            price = product['attributes']['price']['USD']['amount'] / 100
+            total += price * quantity
+            items.append({
+                'id': product_id,
+                'product_id': product_id,
+                'name': product['attributes']['name'],
+                'description': product['attributes']['description'],
+                'quantity': quantity,
+                'meta': {'display_price': {'without_tax': {
+                    'unit': {'formatted': f'${price:.2f}'}}}},
+            })
+        return {'data': items, 'meta': {'display_price': {
+            'without_tax': {'formatted': f'${total:.2f}'}}}}
+
+    def handle(self, method: str, url: str, body: dict) -> tuple[int, dict]:
+        parts = urlsplit(url)
+        path, query = parts.path, parse_qs(parts.query)
+        with self._lock:
+            self.calls[f'{method} {metrics.get_endpoint(path)}'] += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return 503, {'errors': [{'status': 503}]}
+            if path == '/oauth/access_token':
+                return 200, {'access_token': 'fake-token',
+                             'expires': time.time() + 3600}
+            if path == '/catalog/products':
+                return 200, self._page(self.products, query)
+            if path == '/v2/categories':
+                return 200, self._page(self.categories, query)
+            if path == '/v2/inventories':
+                inventories = [{'id': product['id'], 'available': 100}
+                               for product in self.products]
+                return 200, self._page(inventories, query)
+            if match := INVENTORY_PATTERN.match(path):
+                return 200, {'data': {'id': match[1], 'available': 100}}
+            if match := FILE_PATTERN.match(path):
+                href = f'{self.base_url}/images/{match[1]}.jpg'
+                return 200, {'data': {'link': {'href': href}}}
+            if path == '/v2/customers':
+                return 201, {'data': {'id': f'customer-{random.random()}'}}
+            match = CART_ITEMS_PATTERN.match(path)
+            if not match:
+                return 404, {'errors': [{'status': 404}]}
+            chat_id, product_id = match.groups()
+            cart = self.carts[chat_id]
+            if method == 'POST':
+                item = body['data']
+                cart[item['id']] = cart.get(item['id'], 0) + item['quantity']
+            elif method == 'DELETE' and product_id:
+                cart.pop(product_id, None)
+            elif method == 'DELETE':
+                cart.clear()
+            return 200, self._cart(chat_id)
+
+    def make_handler(self):
+        elasticpath = self
+
+        class FakeElasticpathHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self, method: str):
+                length = int(self.headers.get('Content-Length', 0))
+                raw_body = self.rfile.read(length) if length else b''
+                try:
+                    body = json.loads(raw_body) if raw_body else {}
+                except ValueError:
+                    body = {}
+                time.sleep(elasticpath.latency)
+                if self.path.startswith('/images/'):
+                    status, payload = 200, b'\xff\xd8\xff\xe0' + b'0' * 2048
+                    content_type = 'image/jpeg'
+                else:
+                    status, response = elasticpath.handle(method, self.path,
+                                                          body)
+                    payload = json.dumps(response).encode('utf-8')
+                    content_type = 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def do_DELETE(self):
+                self._respond('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeElasticpathHandler
+
+    def serve(self) -> str:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.base_url = f'http://127.0.0.1:{server.server_port}'
+        return self.base_url
+
+
+class FakeBot(Bot):
+    """Бот, который не ходит в Telegram: отвечает на вызовы Bot API
+    выдуманными сообщениями через `latency` секунд и запоминает
+    последнее сообщение в каждом чате."""
+
+    MESSAGE_METHODS = ('sendMessage', 'sendPhoto', 'editMessageText',
+                       'editMessageCaption', 'editMessageReplyMarkup')
+
+    def __init__(self, latency: float):
+        super().__init__(FAKE_TG_TOKEN)
+        self.latency = latency
+        self.calls = Counter()
+        self.last_messages = {}
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _post(self, endpoint: str, data: dict = None, timeout=None,
+              api_kwargs: dict = None):
+        data = data or {}
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[endpoint] += 1
+        if endpoint not in self.MESSAGE_METHODS:
+            return True
+        chat_id = int(data['chat_id'])
+        message = {
+            'message_id': data.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot'},
+        }
+        previous = self.last_messages.get(chat_id, {})
+        if endpoint == 'sendPhoto' or endpoint == 'editMessageCaption' \
+                or endpoint == 'editMessageReplyMarkup' \
+                and 'photo' in previous:
+            message['photo'] = [{'file_id': f'file-{message["message_id"]}',
+                                 'file_unique_id': str(message['message_id']),
+                                 'width': 640, 'height': 480}]
+            message['caption'] = data.get('caption', '')
+        else:
+            message['text'] = data.get('text') or previous.get('text', '')
+        self.last_messages[chat_id] = message
+        return message
+
+
+def make_script(chat_id: int, product_ids: list, pages: int,
+                page_presses: int) -> list:
+    """Разговор одного покупателя: открыть меню, полистать страницы,
+    добавить товар в корзину и оформить заказ. Для каждого шага указано
+    состояние, в котором покупатель видит нужную кнопку."""
+    script = [('message', '/start', None)]
+    for _ in range(page_presses):
+        script.append(('callback', str(random.randrange(max(pages, 1))),
+                       'HANDLE_MENU'))
+    script += [
+        ('callback', random.choice(product_ids), 'HANDLE_MENU'),
+        ('callback', '5 кг', 'HANDLE_DESCRIPTION'),
+        ('callback', 'Корзина', 'HANDLE_DESCRIPTION'),
+        ('callback', 'Оплатить', 'HANDLE_CART'),
+        ('message', f'user{chat_id}@example.com', 'WAITING_EMAIL'),
+        ('callback', 'Верно', 'WAITING_EMAIL'),
+    ]
+    return script
+
+
+def run_chat(dispatcher: Dispatcher, fake_bot: FakeBot, chat_id: int,
+             script: list, products_per_page: int, timings: dict) -> bool:
+    """Проходит разговор по шагам. Если после неудачного обновления
+    бот остался в другом состоянии, покупатель не видит следующей
+    кнопки, поэтому разговор обрывается и возвращается `False`."""
+    stored_state = 'START'
+    for kind, payload, expected_state in script:
+        if expected_state is not None and stored_state != expected_state:
+            return False
+        if kind == 'message':
+            raw_update = make_message_update(chat_id, payload)
+        else:
+            raw_update = make_callback_update(
+                chat_id, payload, fake_bot.last_messages.get(chat_id))
+        update = Update.de_json(raw_update, fake_bot)
+        context = CallbackContext.from_update(update, dispatcher)
+        state = 'START' if payload == '/start' else stored_state
+        started_at = time.perf_counter()
+        bot.handle_users_reply(update, context, products_per_page)
+        timings[state].append(time.perf_counter() - started_at)
+        stored_state = bot._database.hget(f'chat_{chat_id}', 'state')
+        stored_state = stored_state.decode('utf-8') if stored_state \
+            else 'START'
+        dispatcher.bot_data['outbox'].wait(chat_id)
+    return True
+
+
+def get_percentile(values: list, percentile: float) -> float:
+    position = max(math.ceil(percentile * len(values)) - 1, 0)
+    return sorted(values)[position]
+
+
+def get_database(redis_url: str):
+    if redis_url:
+        parts = urlsplit(redis_url)
+        return bot.get_database_connection(parts.password, parts.hostname,
+                                           parts.port or 6379,
+                                           max_connections=64)
+    if fakeredis is None:
+        sys.exit('Установите fakeredis или укажите --redis-url')
+    bot._database = fakeredis.FakeRedis()
+    return bot._database
+
+
+def print_report(timings: dict, elapsed: float,
+                 elasticpath: FakeElasticpath, fake_bot: FakeBot) -> None:
+    updates = sum(len(values) for values in timings.values())
+    print(f'Обработано {updates} обновлений за {elapsed:.2f} с '
+          f'({updates / elapsed:.0f} в секунду)')
+    upstream_calls = sum(elasticpath.calls.values())
+    telegram_calls = sum(fake_bot.calls.values())
+    print(f'Запросов к Elasticpath на обновление: '
+          f'{upstream_calls / updates:.2f} (ошибок {elasticpath.errors}), '
+          f'к Telegram: {telegram_calls / updates:.2f}')
+    for endpoint, calls in elasticpath.calls.most_common():
+        print(f'  {endpoint}: {calls}')
+    roundtrips = {key[0]: total for key, (count, total)
+                  in metrics.REDIS_ROUNDTRIPS.totals().items()}
+    print(f'{"Состояние":<20}{"обновлений":>11}{"p50, мс":>9}'
+          f'{"p95, мс":>9}{"p99, мс":>9}{"Redis":>7}')
+    for state, values in timings.items():
+        redis_per_update = f'{roundtrips[state] / len(values):.1f}' \
+            if roundtrips.get(state) else '-'
+        print(f'{state:<20}{len(values):>11}'
+              f'{get_percentile(values, 0.5) * 1000:>9.1f}'
+              f'{get_percentile(values, 0.95) * 1000:>9.1f}'
+              f'{get_percentile(values, 0.99) * 1000:>9.1f}'
+              f'{redis_per_update:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный тест бота без Telegram и Elasticpath'
+    )
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--page-presses', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--products-per-page', type=int, default=6)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='задержка ответа Elasticpath, с')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='доля ответов Elasticpath с ошибкой 503')
+    parser.add_argument('--telegram-latency', type=float, default=0.01,
+                        help='задержка ответа Telegram, с')
+    parser.add_argument('--redis-url', default=None,
+                        help='адрес Redis, по умолчанию fakeredis')
+    parser.add_argument('--max-p95', type=float, default=None,
+                        help='завершиться с ошибкой, если p95 любого '
+                        'состояния больше, мс')
+    args = parser.parse_args()
+
+    elasticpath = FakeElasticpath(args.products, args.latency,
+                                  args.error_rate)
+    moltin_api.API_URL = elasticpath.serve()
+    os.environ.setdefault('ELASTICPATH_CLIENT_SECRET', 'benchmark')
+    os.environ.setdefault('ELASTICPATH_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('MOLTIN_POOL_SIZE', str(args.concurrency))
+    os.environ.setdefault('TELEGRAM_RATE', '0')
+    os.environ.setdefault('TELEGRAM_CHAT_RATE', '0')
+    env = Env()
+
+    database = get_database(args.redis_url)
+    fake_bot = FakeBot(args.telegram_latency)
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(fake_bot, Queue(), workers=0, job_queue=job_queue)
+    job_queue.set_dispatcher(dispatcher)
+    bot.prepare_dispatcher(dispatcher, env, database)
+
+    product_ids = [product['id'] for product in elasticpath.products]
+    pages = math.ceil(len(product_ids) / args.products_per_page)
+    timings = defaultdict(list)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {}
+        for chat_id in range(1, args.chats + 1):
+            script = make_script(chat_id, product_ids, pages,
+                                 args.page_presses)
+            future = executor.submit(run_chat, dispatcher, fake_bot, chat_id,
+                                     script, args.products_per_page, timings)
+            futures[future] = chat_id
+    failed_chats = 0
+    broken_chats = 0
+    for future, chat_id in futures.items():
+        try:
+            if not future.result():
+                broken_chats += 1
+        except Exception as err:
+            failed_chats += 1
+            logger.warning(f'Разговор чата {chat_id} прерван\n{err!r}\n')
+    elapsed = time.perf_counter() - started_at
+    print_report(timings, elapsed, elasticpath, fake_bot)
+
+    update_errors = metrics.UPDATE_ERRORS.totals()
+    upstream_errors = sum(count for (_, reason), count
+                          in update_errors.items() if reason == 'elasticpath')
+    failed_updates = failed_chats + sum(update_errors.values()) \
+        - upstream_errors
+    failed_sends = metrics.TELEGRAM_CALLS.totals().get(('failed',), 0)
+    print(f'Прерванных разговоров: {failed_chats}, обновлений с ошибкой: '
+          f'{failed_updates}, неотправленных запросов к Telegram: '
+          f'{failed_sends}')
+    print(f'Обновлений с ошибкой Elasticpath: {upstream_errors}, '
+          f'разговоров, оборванных после неё: {broken_chats}')
+    # С --error-rate эти ошибки вызывает сама заглушка: фото товара
+    # отправляется вместе с загрузкой картинки из Elasticpath.
+    elasticpath_failures = upstream_errors + broken_chats + failed_sends
+    if failed_updates or elasticpath_failures and not args.error_rate:
+        sys.exit('Бот обработал не все обновления без ошибок')
+    if args.max_p95 is not None:
+        slow_states = [state for state, values in timings.items()
+                       if get_percentile(values, 0.95) * 1000 > args.max_p95]
+        if slow_states:
+            sys.exit(f'p95 больше {args.max_p95} мс: {", ".join(slow_states)}')
+
+
+if __name__ == '__main__':
+    main()
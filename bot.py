@@ -1,4 +1,6 @@
 import logging
+from collections.abc import Mapping
+from itertools import chain
 from math import ceil
 from textwrap import dedent
 from functools import partial
@@ -9,32 +11,65 @@ from validate_email import validate_email
 from environs import Env
 from telegram import ParseMode
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Filters, Updater, CallbackContext
+from telegram import InlineQueryResultArticle, InputTextMessageContent
+from telegram import Bot, CallbackQuery, Message
+from telegram.error import BadRequest
+from telegram.ext import Filters, Updater, CallbackContext, Dispatcher
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
-
-from moltin_api import (get_access_token, get_products, get_product_image,
-                        put_product_in_cart, get_user_cart, create_customer,
-                        delete_cart_product, delete_all_cart_products)
+from telegram.ext import InlineQueryHandler
+
+import metrics
+from access_token import AccessTokenManager
+from carts import (EMPTY_CART, get_cart, add_to_cart, remove_from_cart,
+                   remember_cart, track_active_cart, reconcile_active_carts)
+from catalog import CatalogCache, parse_categories, parse_stock
+from chat_scheduler import ChatScheduler
+from checkout import (CheckoutWorker, CustomerCache, enqueue_checkout,
+                      get_cart_item_ids, get_customer_name)
+from images import ImageDiskCache, TelegramFileIdCache, send_product_photo
+from moltin_api import (configure_client, fetch_access_token,
+                        iter_catalog_products, iter_inventories,
+                        iter_categories, get_product_stock,
+                        UpstreamScheduler)
+from outbox import Outbox
+from render_cache import RenderCache
+from search import SearchIndex
+from session import ChatSession, configure_sessions
 
 logger = logging.getLogger(__name__)
+
+CHECKOUT_ACCEPTED = 'Заказ принят! Ожидайте уведомление на почте'
+CHECKOUT_PENDING = 'Заказ уже оформляется, ожидайте уведомление на почте'
 _database = None
 
 
-def parse_products(raw_products: list, inventories: list) -> dict:
-    products = {}
-    for raw_product in raw_products:
-        attributes = raw_product.get('attributes')
-        product = {
-            'name': attributes.get('name'),
-            'description': attributes.get('description'),
-            'price': attributes.get('price').get('USD').get('amount') / 100,
-            'image_id': raw_product.get('relationships')
-            .get('main_image').get('data').get('id')
-            }
-        products[raw_product.get('id')] = product
-    for inventory in inventories:
-        products.get(inventory.get('id'))['stock'] = inventory.get('available')
-    return products
+def get_cached_products(context: CallbackContext) -> Mapping:
+    store_access_token = context.bot_data['store_access_token']
+    return context.bot_data['catalog_cache'].get(store_access_token)
+
+
+def search_products(context: CallbackContext, query_text: str,
+                    limit: int) -> list:
+    catalog_cache = context.bot_data['catalog_cache']
+    catalog_version = (catalog_cache.version, catalog_cache.categories.version)
+    products = get_cached_products(context)
+    categories = catalog_cache.get_categories(
+        context.bot_data['store_access_token'])
+    search_index = context.bot_data['search_index']
+    search_index.sync(catalog_version, products.index, categories)
+    return search_index.search(query_text, limit)
+
+
+def mark_cart_active(context: CallbackContext) -> None:
+    if context.bot_data['cart_reconcile_interval']:
+        session = context.chat_data['session']
+        track_active_cart(_database, session.chat_id)
+
+
+def reconcile_carts(context: CallbackContext) -> None:
+    store_access_token = context.bot_data['token_manager'].get()
+    reconcile_active_carts(_database, store_access_token,
+                           context.bot_data['cart_max_age'])
 
 
 def is_number(possible_number):
@@ -45,20 +80,15 @@ def is_number(possible_number):
         return False
 
 
-def get_menu_buttons(products: dict, products_per_page: int,
+def get_menu_buttons(products: Mapping, products_per_page: int,
                      pages_number: int, page: int = 0) -> list:
     keyboard = []
-    pages_range = (range(page * products_per_page, page *
-                         products_per_page + products_per_page))
-    product_number = 0
-    for product_id, product in products.items():
-        if product_number in pages_range:
-            button = [
-                InlineKeyboardButton(product.get('name'),
-                                     callback_data=product_id)
-                    ]
-            keyboard.append(button)
-        product_number += 1
+    for product_id in products.page(page, products_per_page):
+        button = [
+            InlineKeyboardButton(products.index[product_id].get('name'),
+                                 callback_data=product_id)
+                ]
+        keyboard.append(button)
     if pages_number > 1:
         keyboard.append([InlineKeyboardButton('<', callback_data=page - 1),
                          InlineKeyboardButton('>', callback_data=page + 1)]
@@ -67,6 +97,33 @@ def get_menu_buttons(products: dict, products_per_page: int,
     return keyboard
 
 
+def prefetch_menu_images(context: CallbackContext, products: Mapping,
+                         page: int) -> None:
+    image_cache = context.bot_data['image_cache']
+    if image_cache is None:
+        return
+    products_per_page = context.bot_data['products_per_page']
+    image_ids = [products.index[product_id].get('image_id')
+                 for product_id in products.page(page, products_per_page)]
+    image_cache.prefetch(context.bot_data['store_access_token'], image_ids)
+
+
+def get_menu_markup(context: CallbackContext,
+                    page: int = 0) -> InlineKeyboardMarkup:
+    catalog_version = context.bot_data['catalog_cache'].version
+    products = get_cached_products(context)
+    products_per_page = context.bot_data['products_per_page']
+    pages_number = ceil(len(products) / products_per_page)
+    page = 0 if page >= pages_number else page
+    page = pages_number - 1 if page < 0 else page
+    prefetch_menu_images(context, products, page)
+    return context.bot_data['render_cache'].get(
+        catalog_version, ('menu', page, products_per_page),
+        lambda: InlineKeyboardMarkup(get_menu_buttons(
+            products, products_per_page, pages_number, page))
+    )
+
+
 def get_product_quantity_in_cart(product_id, user_cart):
     products = user_cart.get('data')
     if products:
@@ -116,19 +173,15 @@ def prepare_cart_buttons_and_message(user_cart):
     return message, reply_markup
 
 
-def prepare_description_buttons_and_message(product_data, product_quantity):
-    message = dedent(f'''
+def prepare_description_card(product_data):
+    header = dedent(f'''
     <b>{product_data.get('name')}</b>
 
     <u>{product_data.get('price'):.2f}$</u> за 1 кг
-    <u>{product_data.get('stock')}кг</u> на складе
-
+    ''')
+    footer = dedent(f'''
     {product_data.get('description')}
     ''')
-    if product_quantity:
-        message += dedent(f'''
-        В вашей <b>корзине</b> <u>{product_quantity} кг</u> данного товара
-        ''')
     keyboard = [
         [InlineKeyboardButton('1 кг', callback_data='1 кг'),
          InlineKeyboardButton('5 кг', callback_data='5 кг'),
@@ -137,209 +190,315 @@ def prepare_description_buttons_and_message(product_data, product_quantity):
         [InlineKeyboardButton('Назад', callback_data='Назад')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
+    return header, footer, reply_markup
+
+
+def get_description_card(context: CallbackContext, product_id: str,
+                         product_data: dict):
+    return context.bot_data['render_cache'].get(
+        context.bot_data['catalog_cache'].version, ('card', product_id),
+        lambda: prepare_description_card(product_data)
+    )
+
+
+def prepare_description_buttons_and_message(product_data, product_quantity,
+                                            card=None):
+    header, footer, reply_markup = card or prepare_description_card(
+        product_data)
+    message = f"{header}<u>{product_data.get('stock')}кг</u> на складе\n"
+    message += footer
+    if product_quantity:
+        message += dedent(f'''
+        В вашей <b>корзине</b> <u>{product_quantity} кг</u> данного товара
+        ''')
     return message, reply_markup
 
 
+def send_message(context: CallbackContext, chat_id: int, text: str,
+                 reply_markup: InlineKeyboardMarkup = None,
+                 parse_mode: str = None) -> None:
+    context.bot_data['outbox'].put(chat_id, context.bot.send_message,
+                                   text=text, chat_id=chat_id,
+                                   reply_markup=reply_markup,
+                                   parse_mode=parse_mode)
+
+
+def answer_callback_query(context: CallbackContext, query: CallbackQuery,
+                          text: str = None) -> None:
+    context.bot_data['outbox'].put(query.message.chat_id,
+                                   context.bot.answer_callback_query,
+                                   callback_query_id=query.id, text=text,
+                                   cost=0)
+
+
+def replace_message(context: CallbackContext, message: Message, text: str,
+                    reply_markup: InlineKeyboardMarkup = None,
+                    parse_mode: str = None) -> None:
+    context.bot_data['outbox'].put(
+        message.chat_id, deliver_message, context.bot, message, text,
+        reply_markup, parse_mode, context.bot_data['edit_in_place'],
+        key=('replace', message.message_id)
+    )
+
+
+def deliver_message(bot: Bot, message: Message, text: str,
+                    reply_markup: InlineKeyboardMarkup, parse_mode: str,
+                    edit_in_place: bool) -> None:
+    chat_id, message_id = message.chat_id, message.message_id
+    if edit_in_place and message.text is not None:
+        try:
+            if text == message.text and reply_markup:
+                bot.edit_message_reply_markup(chat_id=chat_id,
+                                              message_id=message_id,
+                                              reply_markup=reply_markup)
+            else:
+                bot.edit_message_text(text=text, chat_id=chat_id,
+                                      message_id=message_id,
+                                      reply_markup=reply_markup,
+                                      parse_mode=parse_mode)
+            return
+        except BadRequest as err:
+            if 'not modified' in err.message:
+                return
+    bot.send_message(text=text, chat_id=chat_id, reply_markup=reply_markup,
+                     parse_mode=parse_mode)
+    bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+
+def replace_product_photo(context: CallbackContext, message: Message,
+                          image_id: str, caption: str,
+                          reply_markup: InlineKeyboardMarkup) -> None:
+    context.bot_data['outbox'].put(
+        message.chat_id, deliver_product_photo, context, message, image_id,
+        caption, reply_markup, key=('replace', message.message_id)
+    )
+
+
+def deliver_product_photo(context: CallbackContext, message: Message,
+                          image_id: str, caption: str,
+                          reply_markup: InlineKeyboardMarkup) -> None:
+    bot = context.bot
+    chat_id, message_id = message.chat_id, message.message_id
+    if context.bot_data['edit_in_place'] and message.photo:
+        try:
+            bot.edit_message_caption(chat_id=chat_id, message_id=message_id,
+                                     caption=caption,
+                                     reply_markup=reply_markup,
+                                     parse_mode=ParseMode.HTML)
+            return
+        except BadRequest as err:
+            if 'not modified' in err.message:
+                return
+    send_product_photo(bot, context.bot_data['file_ids'],
+                       context.bot_data['store_access_token'], image_id,
+                       disk_cache=context.bot_data['image_cache'],
+                       chat_id=chat_id, caption=caption,
+                       reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+
+def get_search_markup(context: CallbackContext,
+                      query_text: str) -> tuple[str, InlineKeyboardMarkup]:
+    product_ids = search_products(context, query_text,
+                                  context.bot_data['search_limit'])
+    if not product_ids:
+        return 'Ничего не нашлось. Пожалуйста, выберите товар!', \
+            get_menu_markup(context)
+    products = get_cached_products(context)
+    keyboard = [[InlineKeyboardButton(products.index[product_id].get('name'),
+                                      callback_data=product_id)]
+                for product_id in product_ids]
+    keyboard.append([InlineKeyboardButton('Меню', callback_data=0)])
+    keyboard.append([InlineKeyboardButton('Корзина', callback_data='Корзина')])
+    return 'Вот что нашлось:', InlineKeyboardMarkup(keyboard)
+
+
+def search(update: Update, context: CallbackContext) -> str:
+    query_text = update.message.text.partition(' ')[2]
+    text, reply_markup = get_search_markup(context, query_text)
+    send_message(context, update.message.chat_id, text=text,
+                 reply_markup=reply_markup)
+    return 'HANDLE_MENU'
+
+
+def handle_inline_query(update: Update, context: CallbackContext) -> None:
+    inline_query = update.inline_query
+    try:
+        context.bot_data['store_access_token'] = \
+            context.bot_data['token_manager'].get()
+    except requests.exceptions.HTTPError as err:
+        logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+        return
+    product_ids = search_products(context, inline_query.query,
+                                  context.bot_data['search_limit'])
+    products = get_cached_products(context)
+    results = []
+    for product_id in product_ids:
+        product_data = products[product_id]
+        header, footer, _ = prepare_description_card(product_data)
+        results.append(InlineQueryResultArticle(
+            id=product_id,
+            title=product_data.get('name'),
+            description=f"{product_data.get('price'):.2f}$ за 1 кг",
+            input_message_content=InputTextMessageContent(
+                header + footer, parse_mode=ParseMode.HTML)
+        ))
+    inline_query.answer(results, cache_time=60)
+
+
 def start(update: Update, context: CallbackContext) -> str:
-    store_access_token = context.bot_data['store_access_token']
-    products_per_page = context.bot_data['products_per_page']
-    raw_products, inventories = get_products(store_access_token)
-    products = parse_products(raw_products, inventories)
-    pages_number = ceil(len(products) / products_per_page)
-    keyboard = get_menu_buttons(products, products_per_page, pages_number)
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(text='Пожалуйста, выберите товар!',
-                              reply_markup=reply_markup)
+    reply_markup = get_menu_markup(context)
+    send_message(context, update.message.chat_id,
+                 text='Пожалуйста, выберите товар!',
+                 reply_markup=reply_markup)
     return 'HANDLE_MENU'
 
 
 def handle_menu(update: Update, context: CallbackContext) -> str:
-    bot = context.bot
     query = update.callback_query
     if not query:
         return 'HANDLE_MENU'
-    chat_id = query.message.chat_id
     user_reply = query.data
     store_access_token = context.bot_data['store_access_token']
     if is_number(user_reply):
-        user_reply = int(user_reply)
-        products_per_page = context.bot_data['products_per_page']
-        raw_products, inventories = get_products(store_access_token)
-        products = parse_products(raw_products, inventories)
-
-        pages_number = ceil(len(products) / products_per_page)
-        user_reply = 0 if user_reply >= pages_number else user_reply
-        user_reply = pages_number - 1 if user_reply < 0 else user_reply
-
-        keyboard = get_menu_buttons(products, products_per_page,
-                                    pages_number, user_reply)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        bot.send_message(text='Пожалуйста, выберите товар!', chat_id=chat_id,
-                         reply_markup=reply_markup)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
+        reply_markup = get_menu_markup(context, int(user_reply))
+        replace_message(context, query.message,
+                        text='Пожалуйста, выберите товар!',
+                        reply_markup=reply_markup)
         return 'HANDLE_MENU'
-    user_cart = get_user_cart(store_access_token, chat_id)
+    user_cart = get_cart(context.chat_data['session'], store_access_token,
+                         context.bot_data['cart_max_age'])
     if user_reply == 'Корзина':
         message, reply_markup = prepare_cart_buttons_and_message(user_cart)
-        bot.send_message(chat_id=chat_id, text=message,
-                         reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
+        replace_message(context, query.message, text=message,
+                        reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         return 'HANDLE_CART'
-    raw_products, inventories = get_products(store_access_token)
-    products = parse_products(raw_products, inventories)
-    context.bot_data['product_id'] = user_reply
+    if context.bot_data['refresh_stock_on_open']:
+        context.bot_data['catalog_cache'].refresh_product_stock(
+            store_access_token, user_reply)
+    products = get_cached_products(context)
+    context.chat_data['session'].set('product_id', user_reply)
     product_data = products.get(user_reply)
-    context.bot_data[f'{user_reply}_data'] = product_data
 
     image_id = product_data.get('image_id')
-    image = get_product_image(store_access_token, image_id)
     quantity_in_cart = get_product_quantity_in_cart(user_reply, user_cart)
+    card = get_description_card(context, user_reply, product_data)
     message, reply_markup = prepare_description_buttons_and_message(
-        product_data, quantity_in_cart)
+        product_data, quantity_in_cart, card)
 
-    bot.send_photo(chat_id=chat_id, photo=image, caption=message,
-                   reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-    bot.delete_message(chat_id=chat_id,
-                       message_id=query.message.message_id)
+    replace_product_photo(context, query.message, image_id, message,
+                          reply_markup)
     return 'HANDLE_DESCRIPTION'
 
 
 def handle_description(update: Update, context: CallbackContext) -> str:
-    bot = context.bot
     query = update.callback_query
     if not query:
         return 'HANDLE_DESCRIPTION'
     user_reply = query.data
-    chat_id = query.message.chat_id
     store_access_token = context.bot_data['store_access_token']
     if user_reply in ['1 кг', '5 кг', '10 кг']:
-        product_id = context.bot_data['product_id']
-        product_data = context.bot_data[f'{product_id}_data']
+        product_id = context.chat_data['session'].get('product_id')
+        product_data = get_cached_products(context).get(product_id)
         quantity = int(user_reply.split()[0])
-        user_cart = put_product_in_cart(store_access_token, product_id,
-                                        quantity, chat_id)
-        bot.answer_callback_query(text='Товар добавлен к корзину',
-                                  callback_query_id=query.id,)
+        user_cart = add_to_cart(context.chat_data['session'],
+                                store_access_token, product_id, quantity)
+        mark_cart_active(context)
+        answer_callback_query(context, query,
+                              text='Товар добавлен к корзину')
 
         quantity_in_cart = get_product_quantity_in_cart(product_id, user_cart)
+        card = get_description_card(context, product_id, product_data)
         message, reply_markup = prepare_description_buttons_and_message(
-            product_data, quantity_in_cart)
+            product_data, quantity_in_cart, card)
         image_id = product_data.get('image_id')
-        image = get_product_image(store_access_token, image_id)
-        bot.send_photo(chat_id=chat_id, photo=image, caption=message,
-                       reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
+        replace_product_photo(context, query.message, image_id, message,
+                              reply_markup)
         return 'HANDLE_DESCRIPTION'
     elif user_reply == 'Корзина':
-        user_cart = get_user_cart(store_access_token, chat_id)
+        user_cart = get_cart(context.chat_data['session'], store_access_token,
+                             context.bot_data['cart_max_age'])
         message, reply_markup = prepare_cart_buttons_and_message(user_cart)
-        bot.send_message(chat_id=chat_id, text=message,
-                         reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
+        replace_message(context, query.message, text=message,
+                        reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         return 'HANDLE_CART'
     else:
-        raw_products, inventories = get_products(store_access_token)
-        products = parse_products(raw_products, inventories)
-        products_per_page = context.bot_data['products_per_page']
-        pages_number = ceil(len(products) / products_per_page)
-        keyboard = get_menu_buttons(products, products_per_page, pages_number)
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = get_menu_markup(context)
 
-        bot.send_message(text='Пожалуйста, выберите товар!', chat_id=chat_id,
-                         reply_markup=reply_markup)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
+        replace_message(context, query.message,
+                        text='Пожалуйста, выберите товар!',
+                        reply_markup=reply_markup)
         return 'HANDLE_MENU'
 
 
 def handle_cart(update: Update, context: CallbackContext) -> str:
-    bot = context.bot
     query = update.callback_query
     if not query:
         return 'HANDLE_CART'
-    chat_id = query.message.chat_id
     user_reply = query.data
     store_access_token = context.bot_data['store_access_token']
     if user_reply.startswith('del_'):
         product_id = user_reply[4::]
-        delete_cart_product(store_access_token, chat_id, product_id)
-        user_cart = get_user_cart(store_access_token, chat_id)
+        user_cart = remove_from_cart(context.chat_data['session'],
+                                     store_access_token, product_id)
+        mark_cart_active(context)
         message, reply_markup = prepare_cart_buttons_and_message(user_cart)
-        bot.send_message(chat_id=chat_id, text=message,
-                         reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
+        replace_message(context, query.message, text=message,
+                        reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         return 'HANDLE_CART'
     elif user_reply == 'В меню':
-        raw_products, inventories = get_products(store_access_token)
-        products = parse_products(raw_products, inventories)
-        products_per_page = context.bot_data['products_per_page']
-        pages_number = ceil(len(products) / products_per_page)
-        keyboard = get_menu_buttons(products, products_per_page, pages_number)
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = get_menu_markup(context)
 
-        bot.send_message(text='Пожалуйста, выберите товар!', chat_id=chat_id,
-                         reply_markup=reply_markup)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
+        replace_message(context, query.message,
+                        text='Пожалуйста, выберите товар!',
+                        reply_markup=reply_markup)
         return 'HANDLE_MENU'
     else:
         message = 'Пришлите, пожалуйста, ваш <b>email</b>'
-        bot.send_message(text=message, chat_id=query.message.chat_id,
-                         parse_mode=ParseMode.HTML)
+        send_message(context, query.message.chat_id, text=message,
+                     parse_mode=ParseMode.HTML)
         return 'WAITING_EMAIL'
 
 
+def get_invalid_email_text(email: str) -> str:
+    return dedent(f'''
+    Данный <b>email: {email}</b> не является настоящим.
+    Пожалуйста, введите актуальную почту
+    ''')
+
+
 def waiting_email(update: Update, context: CallbackContext) -> str:
-    bot = context.bot
     query = update.callback_query
     if query and query.data == 'Неверно':
         message = 'Пришлите, пожалуйста, ваш <b>email</b>'
-        bot.send_message(text=message, chat_id=query.message.chat_id,
-                         parse_mode=ParseMode.HTML)
-        bot.delete_message(chat_id=query.message.chat_id,
-                           message_id=query.message.message_id)
+        replace_message(context, query.message, text=message,
+                        parse_mode=ParseMode.HTML)
         return 'WAITING_EMAIL'
     elif query and query.data == 'Верно':
-        store_access_token = context.bot_data['store_access_token']
         chat_id = query.message.chat_id
-        customer_email = _database.get(f'email_{chat_id}').decode()
+        session = context.chat_data['session']
+        customer_email = session.get('email')
         if not validate_email(customer_email):
-            text = dedent(f'''
-            Данный <b>email: {customer_email}</b> не является настоящим.
-            Пожалуйста, введите актуальную почту
-            ''')
-            bot.send_message(text=text, chat_id=chat_id,
-                             parse_mode=ParseMode.HTML)
-            bot.delete_message(chat_id=chat_id,
-                               message_id=query.message.message_id)
+            replace_message(context, query.message,
+                            text=get_invalid_email_text(customer_email),
+                            parse_mode=ParseMode.HTML)
             return 'WAITING_EMAIL'
-        bot.send_message(text='Ожидайте уведомление на почте', chat_id=chat_id)
-        bot.delete_message(chat_id=chat_id,
-                           message_id=query.message.message_id)
-        if not _database.get(f'customer_{chat_id}'):
-            first_name = name if (name := query.from_user.first_name) else ''
-            last_name = name if (name := query.from_user.last_name) else ''
-            customer_name = (first_name + ' ' + last_name).strip()
-            store_access_token = context.bot_data['store_access_token']
-            customer_id = create_customer(store_access_token, customer_name,
-                                          customer_email)
-            _database.set(f'customer_{chat_id}', customer_id)
-        delete_all_cart_products(store_access_token, chat_id)
-
-        raw_products, inventories = get_products(store_access_token)
-        products = parse_products(raw_products, inventories)
-        products_per_page = context.bot_data['products_per_page']
-        pages_number = ceil(len(products) / products_per_page)
-        keyboard = get_menu_buttons(products, products_per_page, pages_number)
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        user_cart = get_cart(session, context.bot_data['store_access_token'],
+                             context.bot_data['cart_max_age'])
+        is_enqueued = enqueue_checkout(
+            _database, chat_id, customer_email,
+            get_customer_name(query.from_user), session.get('customer_id'),
+            get_cart_item_ids(user_cart)
+        )
+        if is_enqueued:
+            remember_cart(session, EMPTY_CART)
+        text = CHECKOUT_ACCEPTED if is_enqueued else CHECKOUT_PENDING
+        replace_message(context, query.message, text=text)
+
+        reply_markup = get_menu_markup(context)
 
-        bot.send_message(text='Пожалуйста, выберите товар!', chat_id=chat_id,
-                         reply_markup=reply_markup)
+        send_message(context, chat_id, text='Пожалуйста, выберите товар!',
+                     reply_markup=reply_markup)
         return 'HANDLE_MENU'
     else:
         email = update.message.text
@@ -347,31 +506,34 @@ def waiting_email(update: Update, context: CallbackContext) -> str:
         Вы прислали мне эту почту: <b>{email}</b>
         Всё верно?
         ''')
-        chat_id = update.effective_chat.id
-        _database.set(f'email_{chat_id}', email)
+        context.chat_data['session'].set('email', email)
         keyboard = [[InlineKeyboardButton('Верно', callback_data='Верно')],
                     [InlineKeyboardButton('Неверно', callback_data='Неверно')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        update.message.reply_text(text=message, reply_markup=reply_markup,
-                                  parse_mode=ParseMode.HTML)
+        send_message(context, update.message.chat_id, text=message,
+                     reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         return 'WAITING_EMAIL'
 
 
 def handle_users_reply(update: Update, context: CallbackContext,
-                       client_secret: str, client_id: str,
-                       token_lifetime: int, products_per_page: int) -> None:
+                       products_per_page: int) -> None:
+    with metrics.track_update() as update_metrics:
+        process_users_reply(update, context, products_per_page,
+                            update_metrics)
+
+
+def process_users_reply(update: Update, context: CallbackContext,
+                        products_per_page: int,
+                        update_metrics: metrics.UpdateMetrics) -> None:
     try:
-        store_access_token = _database.get('store_access_token')
-        if not store_access_token:
-            store_access_token = get_access_token(client_secret, client_id)
-            _database.setex('store_access_token', token_lifetime,
-                            store_access_token)
-        else:
-            store_access_token = store_access_token.decode('utf-8')
+        store_access_token = context.bot_data['token_manager'].get()
         context.bot_data['products_per_page'] = products_per_page
         context.bot_data['store_access_token'] = store_access_token
     except requests.exceptions.HTTPError as err:
+        metrics.UPDATE_ERRORS.inc(state=update_metrics.state,
+                                  reason='elasticpath')
         logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+        return
 
     if update.message:
         user_reply = update.message.text
@@ -381,75 +543,216 @@ def handle_users_reply(update: Update, context: CallbackContext,
         chat_id = update.callback_query.message.chat_id
     else:
         return
+    with metrics.span('session.load'):
+        session = ChatSession.load(_database, chat_id)
+    context.chat_data['session'] = session
     if user_reply == '/start':
         user_state = 'START'
+    elif user_reply.split(' ', 1)[0] == '/search':
+        user_state = 'SEARCH'
     else:
-        user_state = _database.get(chat_id).decode('utf-8')
+        user_state = session.get('state', 'START')
 
     states_functions = {
         'START': start,
+        'SEARCH': search,
         'HANDLE_MENU': handle_menu,
         'HANDLE_DESCRIPTION': handle_description,
         'HANDLE_CART': handle_cart,
         'WAITING_EMAIL': waiting_email,
     }
     state_handler = states_functions[user_state]
+    update_metrics.state = user_state
     try:
-        next_state = state_handler(update, context)
-        _database.set(chat_id, next_state)
+        with metrics.span(user_state):
+            next_state = state_handler(update, context)
+        session.set('state', next_state)
     except requests.exceptions.HTTPError as err:
+        metrics.UPDATE_ERRORS.inc(state=user_state, reason='elasticpath')
         logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
     except Exception as err:
+        metrics.UPDATE_ERRORS.inc(state=user_state, reason='bot')
         logger.warning(f'Ошибка в работе телеграм бота\n{err}\n')
+    finally:
+        with metrics.span('session.flush'):
+            session.flush(_database)
+        context.chat_data.pop('session', None)
+
+
+def schedule_users_reply(update: Update, context: CallbackContext,
+                         products_per_page: int) -> None:
+    if update.callback_query:
+        query = update.callback_query
+        chat_id = query.message.chat_id
+        key = (query.message.message_id, query.data)
+    elif update.message:
+        chat_id = update.message.chat_id
+        key = None
+    else:
+        return
+    is_scheduled = context.bot_data['chat_scheduler'].submit(
+        chat_id, key, handle_users_reply, update, context,
+        products_per_page=products_per_page
+    )
+    if not is_scheduled:
+        answer_callback_query(context, query)
 
 
 def get_database_connection(database_password: str, database_host: str,
-                            database_port: int) -> redis.Redis:
+                            database_port: int,
+                            max_connections: int = 10) -> redis.Redis:
     global _database
     if _database is None:
-        _database = redis.Redis(host=database_host, port=database_port,
-                                password=database_password)
+        connection_pool = redis.BlockingConnectionPool(
+            host=database_host, port=database_port,
+            password=database_password, max_connections=max_connections,
+            connection_class=metrics.CountingConnection
+        )
+        _database = redis.Redis(connection_pool=connection_pool)
     return _database
 
 
+def prepare_dispatcher(dispatcher: Dispatcher, env: Env,
+                       database: redis.Redis) -> None:
+    client_secret = env.str('ELASTICPATH_CLIENT_SECRET')
+    client_id = env.str('ELASTICPATH_CLIENT_ID')
+    token_lifetime = env.int('TOKEN_LIFETIME', 3600)
+    token_refresh_margin = env.int('TOKEN_REFRESH_MARGIN', 300)
+    catalog_ttl = env.int('CATALOG_TTL', 300)
+    catalog_stale_ttl = env.int('CATALOG_STALE_TTL', 3600)
+    catalog_shared_cache = env.bool('CATALOG_SHARED_CACHE', False)
+    stock_ttl = env.int('STOCK_TTL', 30)
+    stock_stale_ttl = env.int('STOCK_STALE_TTL', 300)
+    refresh_stock_on_open = env.bool('REFRESH_STOCK_ON_OPEN', False)
+    edit_in_place = env.bool('EDIT_IN_PLACE', True)
+    bot_workers = env.int('BOT_WORKERS', 4)
+    chat_locks_shared = env.bool('CHAT_LOCKS_SHARED', False)
+    cart_max_age = env.int('CART_MAX_AGE', 600)
+    cart_reconcile_interval = env.int('CART_RECONCILE_INTERVAL', 0)
+    moltin_pool_size = env.int('MOLTIN_POOL_SIZE', 10)
+    moltin_timeout = env.float('MOLTIN_TIMEOUT', 10)
+    moltin_retries = env.int('MOLTIN_RETRIES', 3)
+    moltin_rate_limit = env.float('MOLTIN_RATE_LIMIT', 0)
+    moltin_burst = env.int('MOLTIN_BURST', 10)
+    moltin_page_limit = env.int('MOLTIN_PAGE_LIMIT', 100)
+    moltin_page_concurrency = env.int('MOLTIN_PAGE_CONCURRENCY', 4)
+    search_limit = env.int('SEARCH_LIMIT', 20)
+    metrics_port = env.int('METRICS_PORT', 0)
+    trace_sample_rate = env.float('TRACE_SAMPLE_RATE', 0)
+    image_cache_dir = env.str('IMAGE_CACHE_DIR', None)
+    image_cache_size = env.int('IMAGE_CACHE_SIZE', 256)
+    image_max_side = env.int('IMAGE_MAX_SIDE', 1280)
+    checkout_workers = env.int('CHECKOUT_WORKERS', 1)
+    checkout_batch_size = env.int('CHECKOUT_BATCH_SIZE', 20)
+    checkout_retries = env.int('CHECKOUT_RETRIES', 3)
+    checkout_check_mx = env.bool('CHECKOUT_CHECK_MX', False)
+    telegram_rate = env.float('TELEGRAM_RATE', 30)
+    telegram_chat_rate = env.float('TELEGRAM_CHAT_RATE', 1)
+    telegram_chat_burst = env.int('TELEGRAM_CHAT_BURST', 3)
+    telegram_send_workers = env.int('TELEGRAM_SEND_WORKERS', 8)
+    telegram_send_retries = env.int('TELEGRAM_SEND_RETRIES', 3)
+    session_ttl = env.int('SESSION_TTL', 30 * 24 * 60 * 60)
+    session_cache_size = env.int('SESSION_CACHE_SIZE', 1024)
+
+    metrics.configure(metrics_port, trace_sample_rate=trace_sample_rate)
+    configure_sessions(ttl=session_ttl, cache_size=session_cache_size)
+    token_manager = AccessTokenManager(
+        partial(fetch_access_token, client_secret, client_id),
+        database=database, refresh_margin=token_refresh_margin,
+        default_lifetime=token_lifetime
+    )
+    configure_client(pool_size=moltin_pool_size, timeout=moltin_timeout,
+                     retries=moltin_retries, token_manager=token_manager,
+                     scheduler=UpstreamScheduler(moltin_rate_limit,
+                                                 moltin_burst),
+                     page_limit=moltin_page_limit,
+                     page_concurrency=moltin_page_concurrency)
+    dispatcher.bot_data['token_manager'] = token_manager
+    dispatcher.bot_data['catalog_cache'] = CatalogCache(
+        iter_catalog_products,
+        lambda token: parse_stock(
+            chain.from_iterable(iter_inventories(token))),
+        get_product_stock,
+        lambda token: parse_categories(
+            chain.from_iterable(iter_categories(token))),
+        ttl=catalog_ttl, stale_ttl=catalog_stale_ttl,
+        stock_ttl=stock_ttl, stock_stale_ttl=stock_stale_ttl,
+        database=database if catalog_shared_cache else None
+    )
+    dispatcher.bot_data['refresh_stock_on_open'] = refresh_stock_on_open
+    dispatcher.bot_data['render_cache'] = RenderCache()
+    dispatcher.bot_data['search_index'] = SearchIndex()
+    dispatcher.bot_data['search_limit'] = search_limit
+    dispatcher.bot_data['edit_in_place'] = edit_in_place
+    outbox = Outbox(rate=telegram_rate, chat_rate=telegram_chat_rate,
+                    chat_burst=telegram_chat_burst,
+                    workers=telegram_send_workers,
+                    retries=telegram_send_retries)
+    dispatcher.bot_data['outbox'] = outbox
+    dispatcher.bot_data['chat_scheduler'] = ChatScheduler(
+        bot_workers, database=database if chat_locks_shared else None)
+    dispatcher.bot_data['file_ids'] = TelegramFileIdCache(database)
+    dispatcher.bot_data['image_cache'] = ImageDiskCache(
+        image_cache_dir, image_cache_size * 1024 * 1024,
+        max_side=image_max_side
+    ) if image_cache_dir else None
+    dispatcher.bot_data['cart_max_age'] = cart_max_age
+    dispatcher.bot_data['cart_reconcile_interval'] = cart_reconcile_interval
+    if cart_reconcile_interval:
+        dispatcher.job_queue.run_repeating(reconcile_carts,
+                                           cart_reconcile_interval)
+    if checkout_workers:
+        CheckoutWorker(
+            database, dispatcher.bot, token_manager, CustomerCache(database),
+            batch_size=checkout_batch_size, retries=checkout_retries,
+            check_mx=checkout_check_mx, outbox=outbox
+        ).start(checkout_workers)
+
+
+def add_handlers(dispatcher: Dispatcher, products_per_page: int,
+                 scheduled: bool = True) -> None:
+    """Если `scheduled` ложно, обновление обрабатывается сразу в потоке
+    вызывающего, а не в очереди `ChatScheduler`."""
+    users_reply = schedule_users_reply if scheduled else handle_users_reply
+    dispatcher.add_handler(CallbackQueryHandler(
+        partial(users_reply,
+                products_per_page=products_per_page))
+                           )
+    dispatcher.add_handler(MessageHandler(
+        Filters.text,
+        partial(users_reply,
+                products_per_page=products_per_page))
+                           )
+    dispatcher.add_handler(CommandHandler(
+        'start',
+        partial(users_reply,
+                products_per_page=products_per_page))
+                           )
+    dispatcher.add_handler(InlineQueryHandler(handle_inline_query))
+
+
 def main():
     env = Env()
     env.read_env()
-    client_secret = env.str('ELASTICPATH_CLIENT_SECRET')
-    client_id = env.str('ELASTICPATH_CLIENT_ID')
-    token_lifetime = env.int('TOKEN_LIFETIME')
     products_per_page = env.int('PRODUCTS_PER_PAGE', 6)
     database_password = env.str("REDIS_PASSWORD")
     database_host = env.str("REDIS_HOST")
     database_port = env.int("REDIS_PORT")
+    bot_workers = env.int('BOT_WORKERS', 4)
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.INFO
     )
     logger.setLevel(logging.INFO)
 
-    _ = get_database_connection(database_password, database_host,
-                                database_port)
+    database = get_database_connection(database_password, database_host,
+                                       database_port,
+                                       max_connections=bot_workers + 4)
     tg_token = env.str('FISH_SHOP_BOT_TG_TOKEN')
-    updater = Updater(tg_token)
+    updater = Updater(tg_token, workers=bot_workers)
     dispatcher = updater.dispatcher
-    dispatcher.add_handler(CallbackQueryHandler(
-        partial(handle_users_reply, client_secret=client_secret,
-                client_id=client_id, token_lifetime=token_lifetime,
-                products_per_page=products_per_page))
-                           )
-    dispatcher.add_handler(MessageHandler(
-        Filters.text,
-        partial(handle_users_reply, client_secret=client_secret,
-                client_id=client_id, token_lifetime=token_lifetime,
-                products_per_page=products_per_page))
-                           )
-    dispatcher.add_handler(CommandHandler(
-        'start',
-        partial(handle_users_reply, client_secret=client_secret,
-                client_id=client_id, token_lifetime=token_lifetime,
-                products_per_page=products_per_page))
-                           )
+    prepare_dispatcher(dispatcher, env, database)
+    add_handlers(dispatcher, products_per_page)
     logger.info('Телеграм бот запущен')
     updater.start_polling()
     updater.idle()
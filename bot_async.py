@@ -0,0 +1,392 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from textwrap import dedent
+from functools import partial
+
+import httpx
+import redis.asyncio as aioredis
+import requests
+from validate_email import validate_email
+from environs import Env
+from telegram import ParseMode
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Filters, Updater, CallbackContext
+from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
+from telegram.ext import InlineQueryHandler
+
+import metrics
+import moltin_api_async
+from bot import get_database_connection as get_sync_database_connection
+from bot import CHECKOUT_ACCEPTED, CHECKOUT_PENDING
+from bot import (answer_callback_query, get_cached_products,
+                 get_menu_markup, is_number,
+                 get_description_card, get_invalid_email_text,
+                 get_product_quantity_in_cart,
+                 get_search_markup, handle_inline_query,
+                 prepare_cart_buttons_and_message,
+                 prepare_description_buttons_and_message, prepare_dispatcher,
+                 replace_message, replace_product_photo, send_message)
+from carts import (EMPTY_CART, get_cart_async, add_to_cart_async,
+                   remember_cart, remove_from_cart_async,
+                   track_active_cart_async)
+from checkout import (enqueue_checkout_async, get_cart_item_ids,
+                      get_customer_name)
+from session import AsyncChatSession
+
+logger = logging.getLogger(__name__)
+_database = None
+_loop = None
+_chats = {}
+
+
+async def mark_cart_active(context: CallbackContext) -> None:
+    if context.bot_data['cart_reconcile_interval']:
+        session = context.chat_data['session']
+        await track_active_cart_async(_database, session.chat_id)
+
+
+async def send_menu(context: CallbackContext, chat_id: int) -> None:
+    reply_markup = await asyncio.to_thread(get_menu_markup, context)
+    send_message(context, chat_id, text='Пожалуйста, выберите товар!',
+                 reply_markup=reply_markup)
+
+
+async def replace_with_menu(context: CallbackContext, message,
+                            page: int = 0) -> None:
+    reply_markup = await asyncio.to_thread(get_menu_markup, context, page)
+    replace_message(context, message, text='Пожалуйста, выберите товар!',
+                    reply_markup=reply_markup)
+
+
+async def start(update: Update, context: CallbackContext) -> str:
+    await send_menu(context, update.message.chat_id)
+    return 'HANDLE_MENU'
+
+
+async def search(update: Update, context: CallbackContext) -> str:
+    query_text = update.message.text.partition(' ')[2]
+    text, reply_markup = await asyncio.to_thread(get_search_markup, context,
+                                                 query_text)
+    send_message(context, update.message.chat_id, text=text,
+                 reply_markup=reply_markup)
+    return 'HANDLE_MENU'
+
+
+async def handle_menu(update: Update, context: CallbackContext) -> str:
+    query = update.callback_query
+    if not query:
+        return 'HANDLE_MENU'
+    user_reply = query.data
+    store_access_token = context.bot_data['store_access_token']
+    if is_number(user_reply):
+        await replace_with_menu(context, query.message, int(user_reply))
+        return 'HANDLE_MENU'
+    session = context.chat_data['session']
+    cart_max_age = context.bot_data['cart_max_age']
+    if user_reply == 'Корзина':
+        user_cart = await get_cart_async(session, store_access_token,
+                                         cart_max_age)
+        message, reply_markup = prepare_cart_buttons_and_message(user_cart)
+        replace_message(context, query.message, text=message,
+                        reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        return 'HANDLE_CART'
+    user_cart, products = await asyncio.gather(
+        get_cart_async(session, store_access_token, cart_max_age),
+        asyncio.to_thread(get_cached_products, context)
+    )
+    session.set('product_id', user_reply)
+    product_data = products.get(user_reply)
+
+    quantity_in_cart = get_product_quantity_in_cart(user_reply, user_cart)
+    card = get_description_card(context, user_reply, product_data)
+    message, reply_markup = prepare_description_buttons_and_message(
+        product_data, quantity_in_cart, card)
+    replace_product_photo(context, query.message, product_data.get('image_id'),
+                          message, reply_markup)
+    return 'HANDLE_DESCRIPTION'
+
+
+async def handle_description(update: Update, context: CallbackContext) -> str:
+    query = update.callback_query
+    if not query:
+        return 'HANDLE_DESCRIPTION'
+    user_reply = query.data
+    store_access_token = context.bot_data['store_access_token']
+    if user_reply in ['1 кг', '5 кг', '10 кг']:
+        session = context.chat_data['session']
+        product_id = session.get('product_id')
+        quantity = int(user_reply.split()[0])
+        answer_callback_query(context, query,
+                              text='Товар добавлен к корзину')
+        user_cart, products = await asyncio.gather(
+            add_to_cart_async(session, store_access_token, product_id,
+                              quantity),
+            asyncio.to_thread(get_cached_products, context)
+        )
+        await mark_cart_active(context)
+        product_data = products.get(product_id)
+        quantity_in_cart = get_product_quantity_in_cart(product_id, user_cart)
+        card = get_description_card(context, product_id, product_data)
+        message, reply_markup = prepare_description_buttons_and_message(
+            product_data, quantity_in_cart, card)
+        replace_product_photo(context, query.message,
+                              product_data.get('image_id'), message,
+                              reply_markup)
+        return 'HANDLE_DESCRIPTION'
+    elif user_reply == 'Корзина':
+        user_cart = await get_cart_async(context.chat_data['session'],
+                                         store_access_token,
+                                         context.bot_data['cart_max_age'])
+        message, reply_markup = prepare_cart_buttons_and_message(user_cart)
+        replace_message(context, query.message, text=message,
+                        reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        return 'HANDLE_CART'
+    else:
+        await replace_with_menu(context, query.message)
+        return 'HANDLE_MENU'
+
+
+async def handle_cart(update: Update, context: CallbackContext) -> str:
+    query = update.callback_query
+    if not query:
+        return 'HANDLE_CART'
+    chat_id = query.message.chat_id
+    user_reply = query.data
+    store_access_token = context.bot_data['store_access_token']
+    if user_reply.startswith('del_'):
+        product_id = user_reply[4::]
+        user_cart = await remove_from_cart_async(
+            context.chat_data['session'], store_access_token, product_id)
+        await mark_cart_active(context)
+        message, reply_markup = prepare_cart_buttons_and_message(user_cart)
+        replace_message(context, query.message, text=message,
+                        reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        return 'HANDLE_CART'
+    elif user_reply == 'В меню':
+        await replace_with_menu(context, query.message)
+        return 'HANDLE_MENU'
+    else:
+        message = 'Пришлите, пожалуйста, ваш <b>email</b>'
+        send_message(context, chat_id, text=message,
+                     parse_mode=ParseMode.HTML)
+        return 'WAITING_EMAIL'
+
+
+async def waiting_email(update: Update, context: CallbackContext) -> str:
+    query = update.callback_query
+    if query and query.data == 'Неверно':
+        message = 'Пришлите, пожалуйста, ваш <b>email</b>'
+        replace_message(context, query.message, text=message,
+                        parse_mode=ParseMode.HTML)
+        return 'WAITING_EMAIL'
+    elif query and query.data == 'Верно':
+        chat_id = query.message.chat_id
+        session = context.chat_data['session']
+        customer_email = session.get('email')
+        if not validate_email(customer_email):
+            replace_message(context, query.message,
+                            text=get_invalid_email_text(customer_email),
+                            parse_mode=ParseMode.HTML)
+            return 'WAITING_EMAIL'
+        user_cart = await get_cart_async(
+            session, context.bot_data['store_access_token'],
+            context.bot_data['cart_max_age'])
+        is_enqueued = await enqueue_checkout_async(
+            _database, chat_id, customer_email,
+            get_customer_name(query.from_user), session.get('customer_id'),
+            get_cart_item_ids(user_cart)
+        )
+        if is_enqueued:
+            remember_cart(session, EMPTY_CART)
+        text = CHECKOUT_ACCEPTED if is_enqueued else CHECKOUT_PENDING
+        replace_message(context, query.message, text=text)
+        await send_menu(context, chat_id)
+        return 'HANDLE_MENU'
+    else:
+        email = update.message.text
+        message = dedent(f'''
+        Вы прислали мне эту почту: <b>{email}</b>
+        Всё верно?
+        ''')
+        context.chat_data['session'].set('email', email)
+        keyboard = [[InlineKeyboardButton('Верно', callback_data='Верно')],
+                    [InlineKeyboardButton('Неверно', callback_data='Неверно')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        send_message(context, update.message.chat_id, text=message,
+                     reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        return 'WAITING_EMAIL'
+
+
+async def handle_users_reply(update: Update, context: CallbackContext,
+                             products_per_page: int) -> None:
+    with metrics.track_update() as update_metrics:
+        await process_users_reply(update, context, products_per_page,
+                                  update_metrics)
+
+
+async def process_users_reply(update: Update, context: CallbackContext,
+                              products_per_page: int,
+                              update_metrics: metrics.UpdateMetrics) -> None:
+    if update.message:
+        user_reply = update.message.text
+        chat_id = update.message.chat_id
+    elif update.callback_query:
+        user_reply = update.callback_query.data
+        chat_id = update.callback_query.message.chat_id
+    else:
+        return
+    token_manager = context.bot_data['token_manager']
+    try:
+        store_access_token, session = await asyncio.gather(
+            asyncio.to_thread(token_manager.get),
+            AsyncChatSession.load(_database, chat_id)
+        )
+        context.chat_data['session'] = session
+        context.bot_data['products_per_page'] = products_per_page
+        context.bot_data['store_access_token'] = store_access_token
+    except requests.exceptions.HTTPError as err:
+        metrics.UPDATE_ERRORS.inc(state=update_metrics.state,
+                                  reason='elasticpath')
+        logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+        return
+
+    if user_reply == '/start':
+        user_state = 'START'
+    elif user_reply.split(' ', 1)[0] == '/search':
+        user_state = 'SEARCH'
+    else:
+        user_state = session.get('state', 'START')
+
+    states_functions = {
+        'START': start,
+        'SEARCH': search,
+        'HANDLE_MENU': handle_menu,
+        'HANDLE_DESCRIPTION': handle_description,
+        'HANDLE_CART': handle_cart,
+        'WAITING_EMAIL': waiting_email,
+    }
+    state_handler = states_functions[user_state]
+    update_metrics.state = user_state
+    try:
+        with metrics.span(user_state):
+            next_state = await state_handler(update, context)
+        session.set('state', next_state)
+    except httpx.HTTPError as err:
+        metrics.UPDATE_ERRORS.inc(state=user_state, reason='elasticpath')
+        logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+    except Exception as err:
+        metrics.UPDATE_ERRORS.inc(state=user_state, reason='bot')
+        logger.warning(f'Ошибка в работе телеграм бота\n{err}\n')
+    finally:
+        with metrics.span('session.flush'):
+            await session.flush(_database)
+        context.chat_data.pop('session', None)
+
+
+async def handle_chat_update(chat_id: int, key, update: Update,
+                             context: CallbackContext, **kwargs) -> None:
+    chat = _chats.setdefault(chat_id, {'lock': asyncio.Lock(),
+                                       'pending_keys': set(), 'updates': 0})
+    if key is not None and key in chat['pending_keys']:
+        answer_callback_query(context, update.callback_query)
+        return
+    if key is not None:
+        chat['pending_keys'].add(key)
+    chat['updates'] += 1
+    try:
+        async with chat['lock']:
+            await handle_users_reply(update, context, **kwargs)
+    except Exception as err:
+        metrics.UPDATE_ERRORS.inc(state='UNKNOWN', reason='bot')
+        logger.warning(f'Ошибка при обработке чата {chat_id}\n{err}\n')
+    finally:
+        chat['pending_keys'].discard(key)
+        chat['updates'] -= 1
+        if not chat['updates']:
+            del _chats[chat_id]
+
+
+def schedule_users_reply(update: Update, context: CallbackContext,
+                         **kwargs) -> None:
+    if update.callback_query:
+        query = update.callback_query
+        chat_id = query.message.chat_id
+        key = (query.message.message_id, query.data)
+    elif update.message:
+        chat_id = update.message.chat_id
+        key = None
+    else:
+        return
+    asyncio.run_coroutine_threadsafe(
+        handle_chat_update(chat_id, key, update, context, **kwargs), _loop)
+
+
+def start_event_loop(workers: int) -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        _loop.set_default_executor(ThreadPoolExecutor(max_workers=workers))
+        thread = threading.Thread(target=_loop.run_forever, daemon=True)
+        thread.start()
+    return _loop
+
+
+def get_database_connection(database_password: str, database_host: str,
+                            database_port: int,
+                            max_connections: int) -> aioredis.Redis:
+    global _database
+    if _database is None:
+        connection_pool = aioredis.ConnectionPool(
+            host=database_host, port=database_port,
+            password=database_password, max_connections=max_connections,
+            connection_class=metrics.AsyncCountingConnection
+        )
+        _database = aioredis.Redis(connection_pool=connection_pool)
+    return _database
+
+
+def main():
+    env = Env()
+    env.read_env()
+    products_per_page = env.int('PRODUCTS_PER_PAGE', 6)
+    database_password = env.str("REDIS_PASSWORD")
+    database_host = env.str("REDIS_HOST")
+    database_port = env.int("REDIS_PORT")
+    async_pool_size = env.int('ASYNC_POOL_SIZE', 100)
+    async_workers = env.int('ASYNC_WORKERS', 32)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logger.setLevel(logging.INFO)
+
+    database = get_sync_database_connection(database_password, database_host,
+                                            database_port)
+    get_database_connection(database_password, database_host, database_port,
+                            max_connections=async_pool_size)
+    tg_token = env.str('FISH_SHOP_BOT_TG_TOKEN')
+    updater = Updater(tg_token)
+    dispatcher = updater.dispatcher
+    prepare_dispatcher(dispatcher, env, database)
+    moltin_api_async.configure_client(
+        pool_size=async_pool_size,
+        timeout=env.float('MOLTIN_TIMEOUT', 10),
+        retries=env.int('MOLTIN_RETRIES', 3),
+        token_manager=dispatcher.bot_data['token_manager']
+    )
+    start_event_loop(async_workers)
+    callback = partial(schedule_users_reply,
+                       products_per_page=products_per_page)
+    dispatcher.add_handler(CallbackQueryHandler(callback))
+    dispatcher.add_handler(MessageHandler(Filters.text, callback))
+    dispatcher.add_handler(CommandHandler('start', callback))
+    dispatcher.add_handler(InlineQueryHandler(handle_inline_query))
+    logger.info('Телеграм бот запущен в асинхронном режиме')
+    updater.start_polling()
+    updater.idle()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import json
+import logging
+import time
+
+import redis
+import redis.asyncio as aioredis
+
+import metrics
+import moltin_api
+import moltin_api_async
+from session import ChatSession
+
+logger = logging.getLogger(__name__)
+
+EMPTY_CART = {'data': []}
+ACTIVE_CARTS_KEY = 'active_carts'
+
+
+def get_cached_cart(session: ChatSession, max_age: float):
+    cart = session.get('cart')
+    synced_at = float(session.get('cart_synced_at', 0))
+    if cart is None or time.time() - synced_at >= max_age:
+        metrics.count_cache_lookup('cart', 'miss')
+        return None
+    metrics.count_cache_lookup('cart', 'hit')
+    return json.loads(cart)
+
+
+def remember_cart(session: ChatSession, cart: dict) -> dict:
+    session.set('cart', json.dumps(cart, ensure_ascii=False))
+    session.set('cart_synced_at', time.time())
+    return cart
+
+
+def forget_cart(session: ChatSession) -> None:
+    session.set('cart_synced_at', 0)
+
+
+def track_active_cart(database: redis.Redis, chat_id: int) -> None:
+    database.zadd(ACTIVE_CARTS_KEY, {chat_id: time.time()})
+
+
+async def track_active_cart_async(database: aioredis.Redis,
+                                  chat_id: int) -> None:
+    await database.zadd(ACTIVE_CARTS_KEY, {chat_id: time.time()})
+
+
+def get_cart(session: ChatSession, store_access_token: str,
+             max_age: float) -> dict:
+    cart = get_cached_cart(session, max_age)
+    if cart is not None:
+        return cart
+    cart = moltin_api.get_user_cart(store_access_token, session.chat_id)
+    return remember_cart(session, cart)
+
+
+def add_to_cart(session: ChatSession, store_access_token: str,
+                product_id: str, quantity: int) -> dict:
+    try:
+        cart = moltin_api.put_product_in_cart(store_access_token, product_id,
+                                              quantity, session.chat_id)
+    except Exception:
+        forget_cart(session)
+        raise
+    return remember_cart(session, cart)
+
+
+def remove_from_cart(session: ChatSession, store_access_token: str,
+                     product_id: str) -> dict:
+    try:
+        cart = moltin_api.delete_cart_product(store_access_token,
+                                              session.chat_id, product_id)
+    except Exception:
+        forget_cart(session)
+        raise
+    return remember_cart(session, cart)
+
+
+async def get_cart_async(session: ChatSession, store_access_token: str,
+                         max_age: float) -> dict:
+    cart = get_cached_cart(session, max_age)
+    if cart is not None:
+        return cart
+    cart = await moltin_api_async.get_user_cart(store_access_token,
+                                                session.chat_id)
+    return remember_cart(session, cart)
+
+
+async def add_to_cart_async(session: ChatSession, store_access_token: str,
+                            product_id: str, quantity: int) -> dict:
+    try:
+        cart = await moltin_api_async.put_product_in_cart(
+            store_access_token, product_id, quantity, session.chat_id)
+    except Exception:
+        forget_cart(session)
+        raise
+    return remember_cart(session, cart)
+
+
+async def remove_from_cart_async(session: ChatSession,
+                                 store_access_token: str,
+                                 product_id: str) -> dict:
+    try:
+        cart = await moltin_api_async.delete_cart_product(
+            store_access_token, session.chat_id, product_id)
+    except Exception:
+        forget_cart(session)
+        raise
+    return remember_cart(session, cart)
+
+
+def reconcile_active_carts(database: redis.Redis, store_access_token: str,
+                           active_period: float) -> None:
+    now = time.time()
+    database.zremrangebyscore(ACTIVE_CARTS_KEY, 0, now - active_period)
+    for chat_id in database.zrange(ACTIVE_CARTS_KEY, 0, -1):
+        chat_id = int(chat_id)
+        try:
+            cart = moltin_api.get_user_cart(store_access_token, chat_id)
+        except Exception as err:
+            logger.warning(f'Не удалось сверить корзину {chat_id}\n{err}\n')
+            continue
+        session = ChatSession.load(database, chat_id)
+        remember_cart(session, cart)
+        session.flush(database)
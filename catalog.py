@@ -0,0 +1,338 @@
+import json
+import logging
+import threading
+import time
+from collections.abc import Mapping
+from functools import partial
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+PRODUCT_FIELDS = ('name', 'description', 'price', 'image_id', 'categories')
+
+
+def parse_product(raw_product: dict) -> tuple:
+    attributes = raw_product.get('attributes')
+    relationships = raw_product.get('relationships')
+    categories = (relationships.get('categories') or {}).get('data') or []
+    return (
+        attributes.get('name'),
+        attributes.get('description'),
+        attributes.get('price').get('USD').get('amount') / 100,
+        relationships.get('main_image').get('data').get('id'),
+        tuple(category.get('id') for category in categories),
+    )
+
+
+class ProductIndex(Mapping):
+    """Упорядоченный индекс товаров.
+
+    Товар хранится кортежем в своей ячейке списка, а словарь `id →
+    ячейка` нужен только для поиска. Страница меню — это срез списка
+    id, поэтому индекс можно дополнять постранично и отдавать первые
+    страницы меню, пока остальные ещё загружаются.
+    """
+
+    def __init__(self):
+        self._ids = []
+        self._rows = []
+        self._slots = {}
+
+    def add_products(self, raw_products: list) -> None:
+        for raw_product in raw_products:
+            self._add(raw_product.get('id'), parse_product(raw_product))
+
+    def _add(self, product_id: str, row: tuple) -> None:
+        slot = self._slots.get(product_id)
+        if slot is not None:
+            self._rows[slot] = row
+            return
+        self._rows.append(row)
+        self._slots[product_id] = len(self._rows) - 1
+        self._ids.append(product_id)
+
+    def __getitem__(self, product_id: str) -> dict:
+        return dict(zip(PRODUCT_FIELDS, self._rows[self._slots[product_id]]))
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ProductIndex):
+            return NotImplemented
+        return self._ids == other._ids and self._rows == other._rows
+
+    def page(self, page: int, products_per_page: int) -> list:
+        first_product = page * products_per_page
+        return self._ids[first_product:first_product + products_per_page]
+
+    def dump(self) -> list:
+        return [[product_id, *row]
+                for product_id, row in zip(self._ids, self._rows)]
+
+    @classmethod
+    def load(cls, rows: list) -> 'ProductIndex':
+        index = cls()
+        for product_id, *row in rows:
+            index._add(product_id, tuple(
+                tuple(value) if isinstance(value, list) else value
+                for value in row))
+        return index
+
+
+def parse_stock(inventories) -> dict:
+    return {inventory.get('id'): inventory.get('available')
+            for inventory in inventories}
+
+
+def parse_categories(raw_categories) -> dict:
+    return {category.get('id'): category.get('name')
+            for category in raw_categories}
+
+
+class ProductsWithStock(Mapping):
+    """Индекс товаров, к которому остатки на складе добавляются
+    только в момент обращения к конкретному товару.
+
+    `stock` может быть функцией: тогда остатки запрашиваются при первом
+    обращении к товару. Для меню и поиска остатки не нужны, поэтому они
+    читают товары из `index`.
+    """
+
+    def __init__(self, products: dict, stock):
+        self._products = products
+        self._stock = stock
+
+    @property
+    def index(self) -> Mapping:
+        return self._products
+
+    @property
+    def stock(self) -> dict:
+        if callable(self._stock):
+            self._stock = self._stock()
+        return self._stock
+
+    def __getitem__(self, product_id: str) -> dict:
+        product = self._products[product_id]
+        return {**product, 'stock': self.stock.get(product_id)}
+
+    def __iter__(self):
+        return iter(self._products)
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def page(self, page: int, products_per_page: int) -> list:
+        return self._products.page(page, products_per_page)
+
+
+class CachedValue:
+    """Значение с ограниченным временем жизни.
+
+    Свежие данные отдаются сразу, устаревшие (но не старше `stale_ttl`)
+    отдаются сразу же, а обновление запускается в фоновом потоке.
+    Одновременно за значением уходит не больше одного запроса. Если
+    передан `database`, значение дополнительно хранится в Redis и
+    разделяется между несколькими процессами бота. `on_refresh`
+    вызывается после каждой попытки обновления, удачной или нет.
+    """
+
+    def __init__(self, fetch, ttl: int, stale_ttl: int, database=None,
+                 key: str = None, dump=None, load=None, on_refresh=None):
+        self._fetch = fetch
+        self._on_refresh = on_refresh
+        self._dump = dump or (lambda value: value)
+        self._load = load or (lambda value: value)
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self._database = database
+        self._key = key
+        self.value = None
+        self.version = 0
+        self._fetched_at = 0.0
+        self._fetch_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._refreshing = False
+
+    def _age(self) -> float:
+        return time.time() - self._fetched_at
+
+    def get(self, store_access_token: str):
+        value = self.value
+        if value is not None and self._age() < self.ttl:
+            metrics.count_cache_lookup(self._key, 'hit')
+            return value
+        if value is not None and self._age() < self.stale_ttl:
+            metrics.count_cache_lookup(self._key, 'stale')
+            self.refresh_in_background(store_access_token)
+            return value
+        metrics.count_cache_lookup(self._key, 'miss')
+        return self.refresh(store_access_token)
+
+    def refresh(self, store_access_token: str, force: bool = False):
+        try:
+            with self._fetch_lock:
+                if not force and self.value is not None \
+                        and self._age() < self.ttl:
+                    return self.value
+                shared = None if force else self._load_shared()
+                if shared:
+                    value, fetched_at = shared
+                else:
+                    value = self._fetch(store_access_token)
+                    fetched_at = time.time()
+                    self._save_shared(value, fetched_at)
+                if value != self.value:
+                    self.version += 1
+                self.value, self._fetched_at = value, fetched_at
+                return value
+        finally:
+            if self._on_refresh is not None:
+                self._on_refresh()
+
+    def invalidate(self) -> None:
+        with self._fetch_lock:
+            self.value = None
+            self.version += 1
+            self._fetched_at = 0.0
+            if self._database is not None:
+                self._database.delete(self._key)
+
+    def refresh_in_background(self, store_access_token: str) -> None:
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._background_refresh,
+                                  args=(store_access_token,), daemon=True)
+        thread.start()
+
+    def _background_refresh(self, store_access_token: str) -> None:
+        try:
+            self.refresh(store_access_token)
+        except Exception as err:
+            logger.warning(f'Не удалось обновить {self._key}\n{err}\n')
+        finally:
+            with self._state_lock:
+                self._refreshing = False
+
+    def _load_shared(self):
+        if self._database is None:
+            return None
+        raw_value = self._database.get(self._key)
+        if not raw_value:
+            return None
+        cached = json.loads(raw_value)
+        fetched_at = cached.get('fetched_at')
+        if time.time() - fetched_at >= self.ttl:
+            return None
+        return self._load(cached.get('value')), fetched_at
+
+    def _save_shared(self, value, fetched_at: float) -> None:
+        if self._database is None:
+            return
+        cached = {'fetched_at': fetched_at, 'value': self._dump(value)}
+        self._database.setex(self._key, self.stale_ttl,
+                             json.dumps(cached, ensure_ascii=False))
+
+
+class CatalogCache:
+    """Каталог из двух независимо обновляемых частей: редко меняющегося
+    индекса товаров (названия, описания, цены, картинки) и часто
+    меняющихся остатков на складе. Названия категорий нужны только
+    поиску и обновляются с тем же сроком жизни, что и индекс товаров.
+
+    Пока каталог загружается впервые, `get` отдаёт уже загруженные
+    страницы, не дожидаясь остальных, а остатки загружаются в фоне и
+    ожидаются только при открытии карточки товара.
+    """
+
+    def __init__(self, fetch_product_pages, fetch_stock, fetch_product_stock,
+                 fetch_categories, ttl: int = 300, stale_ttl: int = 3600,
+                 stock_ttl: int = 30, stock_stale_ttl: int = 300,
+                 database=None, first_page_timeout: float = 30):
+        self._fetch_product_pages = fetch_product_pages
+        self._fetch_product_stock = fetch_product_stock
+        self.first_page_timeout = first_page_timeout
+        self.products = CachedValue(self._load_products, ttl, stale_ttl,
+                                    database, key='catalog_index',
+                                    dump=ProductIndex.dump,
+                                    load=ProductIndex.load,
+                                    on_refresh=self._finish_refresh)
+        self.stock = CachedValue(fetch_stock, stock_ttl, stock_stale_ttl,
+                                 database, key='catalog_stock')
+        self.categories = CachedValue(fetch_categories, ttl, stale_ttl,
+                                      database, key='catalog_categories')
+        self._loading = None
+        self._refreshes = 0
+        self._loading_changed = threading.Condition()
+
+    def _load_products(self, store_access_token: str) -> ProductIndex:
+        index = ProductIndex()
+        with self._loading_changed:
+            self._loading = index
+        try:
+            for raw_products in self._fetch_product_pages(store_access_token):
+                index.add_products(raw_products)
+                with self._loading_changed:
+                    self._loading_changed.notify_all()
+        finally:
+            with self._loading_changed:
+                self._loading = None
+        return index
+
+    def _finish_refresh(self) -> None:
+        with self._loading_changed:
+            self._refreshes += 1
+            self._loading_changed.notify_all()
+
+    def _wait_for_first_page(self, store_access_token: str):
+        with self._loading_changed:
+            refreshes = self._refreshes
+            self.products.refresh_in_background(store_access_token)
+            self._loading_changed.wait_for(
+                lambda: self.products.value is not None or self._loading
+                or self._refreshes != refreshes,
+                timeout=self.first_page_timeout
+            )
+            return self._loading or None
+
+    @property
+    def version(self):
+        loading = self._loading
+        if self.products.value is None and loading is not None:
+            return self.products.version, len(loading)
+        return self.products.version
+
+    def get(self, store_access_token: str) -> Mapping:
+        products = None
+        if self.products.value is None:
+            products = self._wait_for_first_page(store_access_token)
+        if products is None:
+            products = self.products.get(store_access_token)
+        if self.stock.value is None:
+            self.stock.refresh_in_background(store_access_token)
+            stock = partial(self.stock.get, store_access_token)
+        else:
+            stock = self.stock.get(store_access_token)
+        return ProductsWithStock(products, stock)
+
+    def get_categories(self, store_access_token: str) -> dict:
+        return self.categories.get(store_access_token)
+
+    def refresh_product_stock(self, store_access_token: str,
+                              product_id: str) -> None:
+        stock = self.stock.get(store_access_token)
+        stock[product_id] = self._fetch_product_stock(store_access_token,
+                                                      product_id)
+
+    def invalidate(self) -> None:
+        self.products.invalidate()
+        self.stock.invalidate()
+        self.categories.invalidate()
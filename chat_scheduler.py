@@ -0,0 +1,73 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class ChatScheduler:
+    """Обрабатывает обновления разных чатов параллельно, а одного чата —
+    строго по очереди.
+
+    У каждого чата своя очередь, которую разбирает не больше одного
+    потока из общего пула. Если передан `database`, обработка
+    обновления дополнительно берёт блокировку чата в Redis, чтобы
+    несколько копий бота не обрабатывали один чат одновременно.
+    Повторное нажатие той же кнопки, пока первое ещё в очереди,
+    отбрасывается.
+    """
+
+    def __init__(self, workers: int, database: redis.Redis = None,
+                 lock_timeout: int = 60):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._database = database
+        self._lock_timeout = lock_timeout
+        self._queues = {}
+        self._pending_keys = {}
+        self._guard = threading.Lock()
+
+    def submit(self, chat_id: int, key, func, *args, **kwargs) -> bool:
+        with self._guard:
+            pending_keys = self._pending_keys.setdefault(chat_id, set())
+            if key is not None and key in pending_keys:
+                return False
+            if key is not None:
+                pending_keys.add(key)
+            queue = self._queues.get(chat_id)
+            is_idle = queue is None
+            if is_idle:
+                queue = self._queues[chat_id] = deque()
+            queue.append((key, func, args, kwargs))
+        if is_idle:
+            self._executor.submit(self._drain, chat_id)
+        return True
+
+    def _drain(self, chat_id: int) -> None:
+        while True:
+            with self._guard:
+                queue = self._queues[chat_id]
+                if not queue:
+                    del self._queues[chat_id]
+                    self._pending_keys.pop(chat_id, None)
+                    return
+                key, func, args, kwargs = queue.popleft()
+            try:
+                self._run(chat_id, func, args, kwargs)
+            except Exception as err:
+                logger.warning(f'Ошибка при обработке чата {chat_id}\n{err}\n')
+            finally:
+                with self._guard:
+                    self._pending_keys.get(chat_id, set()).discard(key)
+
+    def _run(self, chat_id: int, func, args, kwargs) -> None:
+        if self._database is None:
+            func(*args, **kwargs)
+            return
+        lock = self._database.lock(f'chat_lock_{chat_id}',
+                                   timeout=self._lock_timeout,
+                                   blocking_timeout=self._lock_timeout)
+        with lock:
+            func(*args, **kwargs)
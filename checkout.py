@@ -0,0 +1,271 @@
+import logging
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import redis.asyncio as aioredis
+import requests
+from telegram import Bot
+from validate_email import validate_email
+
+from moltin_api import (PRIORITY_CHECKOUT, create_customer,
+                        delete_all_cart_products, delete_cart_product)
+from outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+CHECKOUT_STREAM = 'checkout_jobs'
+CHECKOUT_GROUP = 'checkout_workers'
+CHECKOUT_DONE = 'Заказ оформлен! Ожидайте уведомление на почте'
+CHECKOUT_FAILED = 'Не удалось оформить заказ, попробуйте ещё раз'
+
+
+def get_idempotency_key(chat_id: int) -> str:
+    return f'checkout_{chat_id}'
+
+
+def get_customer_name(user) -> str:
+    return ' '.join(filter(None, [user.first_name, user.last_name]))
+
+
+def get_cart_item_ids(cart: dict) -> list:
+    return [item.get('id') for item in cart.get('data') or []]
+
+
+def make_job(chat_id: int, email: str, customer_name: str,
+             customer_id: str = None, cart_items=()) -> tuple[str, dict]:
+    job_id = uuid.uuid4().hex
+    return job_id, {'job_id': job_id, 'chat_id': chat_id, 'email': email,
+                    'customer_name': customer_name,
+                    'customer_id': customer_id or '',
+                    'cart_items': ','.join(cart_items)}
+
+
+def enqueue_checkout(database: redis.Redis, chat_id: int, email: str,
+                     customer_name: str, customer_id: str = None,
+                     cart_items=(), ttl: int = 600) -> bool:
+    """Ставит заказ в очередь. `cart_items` — id позиций корзины,
+    которые входят в заказ: обработчик удалит из корзины только их.
+    Возвращает `False`, если заказ этого чата уже ждёт обработки."""
+    job_id, job = make_job(chat_id, email, customer_name, customer_id,
+                           cart_items)
+    if not database.set(get_idempotency_key(chat_id), job_id, nx=True,
+                        ex=ttl):
+        return False
+    database.xadd(CHECKOUT_STREAM, job)
+    return True
+
+
+async def enqueue_checkout_async(database: aioredis.Redis, chat_id: int,
+                                 email: str, customer_name: str,
+                                 customer_id: str = None, cart_items=(),
+                                 ttl: int = 600) -> bool:
+    job_id, job = make_job(chat_id, email, customer_name, customer_id,
+                           cart_items)
+    if not await database.set(get_idempotency_key(chat_id), job_id, nx=True,
+                              ex=ttl):
+        return False
+    await database.xadd(CHECKOUT_STREAM, job)
+    return True
+
+
+class CustomerCache:
+    """Соответствие email и id покупателя в Elasticpath. Хранится в
+    Redis и дублируется в памяти процесса, чтобы повторный заказ не
+    создавал покупателя заново."""
+
+    def __init__(self, database: redis.Redis, key: str = 'customer_ids'):
+        self._database = database
+        self._key = key
+        self._customer_ids = {}
+
+    def get(self, email: str):
+        customer_id = self._customer_ids.get(email)
+        if customer_id:
+            return customer_id
+        customer_id = self._database.hget(self._key, email)
+        if customer_id:
+            customer_id = customer_id.decode('utf-8')
+            self._customer_ids[email] = customer_id
+        return customer_id
+
+    def set(self, email: str, customer_id: str) -> None:
+        self._customer_ids[email] = customer_id
+        self._database.hset(self._key, email, customer_id)
+
+
+class CheckoutWorker:
+    """Оформляет заказы из очереди `checkout_jobs` в Redis.
+
+    Заказы читаются пачками: адреса почты проверяются, а покупатели
+    создаются параллельно, причём каждый адрес — один раз на пачку.
+    Из корзины удаляются только позиции, которые были в ней при
+    подтверждении заказа, а сессию чата обработчик не меняет.
+    Неудачные запросы повторяются с растущей паузой. Заказ
+    подтверждается в очереди только после того, как покупатель получил
+    ответ, поэтому после перезапуска необработанные заказы дочитываются,
+    а зависшие у другого обработчика — забираются.
+    """
+
+    def __init__(self, database: redis.Redis, bot: Bot, token_manager,
+                 customers: CustomerCache, batch_size: int = 20,
+                 retries: int = 3, backoff_factor: float = 1,
+                 check_mx: bool = False, claim_after: int = 60000,
+                 outbox: Outbox = None):
+        self._database = database
+        self._bot = bot
+        self._token_manager = token_manager
+        self._customers = customers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.check_mx = check_mx
+        self.claim_after = claim_after
+        self._outbox = outbox
+        self._executor = ThreadPoolExecutor(max_workers=batch_size)
+
+    def _with_retries(self, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except requests.exceptions.RequestException as err:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f'Повторяем запрос при оформлении заказа\n'
+                               f'{err}\n')
+                time.sleep(self.backoff_factor * 2 ** attempt)
+
+    def _validate(self, email: str) -> bool:
+        """Формат адреса проверяет бот при подтверждении почты, здесь
+        проверяется только почтовый сервер, если включён `check_mx`."""
+        if not self.check_mx:
+            return True
+        return bool(validate_email(email, check_mx=True))
+
+    def _get_customer_id(self, store_access_token: str, email: str,
+                         customer_name: str) -> str:
+        customer_id = self._customers.get(email)
+        if customer_id:
+            return customer_id
+        customer_id = self._with_retries(create_customer, store_access_token,
+                                         customer_name, email)
+        self._customers.set(email, customer_id)
+        return customer_id
+
+    def _delete_cart_item(self, store_access_token: str, chat_id: int,
+                          item_id: str) -> None:
+        try:
+            delete_cart_product(store_access_token, chat_id, item_id,
+                                PRIORITY_CHECKOUT)
+        except requests.exceptions.HTTPError as err:
+            if err.response is None or err.response.status_code != 404:
+                raise
+
+    def _remove_ordered_items(self, store_access_token: str, chat_id: int,
+                              job: dict) -> None:
+        cart_items = job.get('cart_items')
+        if cart_items is None:
+            # Заказ поставлен в очередь до того, как в него стали
+            # записывать позиции корзины.
+            self._with_retries(delete_all_cart_products, store_access_token,
+                               chat_id)
+            return
+        for item_id in filter(None, cart_items.split(',')):
+            self._with_retries(self._delete_cart_item, store_access_token,
+                               chat_id, item_id)
+
+    def _finish(self, store_access_token: str, job: dict, is_valid: bool,
+                customer_id) -> None:
+        chat_id = int(job['chat_id'])
+        if not is_valid:
+            text = (f'Не нашли почтовый сервер для {job["email"]}, '
+                    f'заказ не оформлен.\nПожалуйста, оформите его '
+                    f'заново из корзины с актуальной почтой')
+        elif isinstance(customer_id, Exception):
+            text = CHECKOUT_FAILED
+        else:
+            try:
+                self._remove_ordered_items(store_access_token, chat_id, job)
+                text = CHECKOUT_DONE
+            except Exception as err:
+                logger.warning(f'Не удалось очистить корзину чата '
+                               f'{chat_id}\n{err}\n')
+                text = CHECKOUT_FAILED
+        if self._outbox is None:
+            self._bot.send_message(chat_id=chat_id, text=text)
+        else:
+            self._outbox.put(chat_id, self._bot.send_message,
+                             chat_id=chat_id, text=text)
+
+    def process(self, entries: list) -> None:
+        jobs = [{field.decode('utf-8'): value.decode('utf-8')
+                 for field, value in fields.items()}
+                for _, fields in entries]
+        store_access_token = self._token_manager.get()
+        emails = list({job['email'] for job in jobs})
+        validity = dict(zip(emails, self._executor.map(self._validate,
+                                                       emails)))
+        pending = {}
+        for job in jobs:
+            if validity[job['email']] and not job['customer_id']:
+                pending.setdefault(job['email'], job['customer_name'])
+        futures = {email: self._executor.submit(
+                       self._get_customer_id, store_access_token, email,
+                       customer_name)
+                   for email, customer_name in pending.items()}
+        for (entry_id, _), job in zip(entries, jobs):
+            is_valid = validity[job['email']]
+            customer_id = job['customer_id'] or None
+            if is_valid and customer_id is None:
+                try:
+                    customer_id = futures[job['email']].result()
+                except Exception as err:
+                    logger.warning(f'Не удалось создать покупателя\n{err}\n')
+                    customer_id = err
+            try:
+                self._finish(store_access_token, job, is_valid, customer_id)
+            except Exception as err:
+                logger.warning(f'Не удалось оформить заказ чата '
+                               f'{job["chat_id"]}\n{err}\n')
+            self._database.delete(get_idempotency_key(job['chat_id']))
+            self._database.xack(CHECKOUT_STREAM, CHECKOUT_GROUP, entry_id)
+            self._database.xdel(CHECKOUT_STREAM, entry_id)
+
+    def run(self, consumer: str) -> None:
+        try:
+            self._database.xgroup_create(CHECKOUT_STREAM, CHECKOUT_GROUP,
+                                         id='0', mkstream=True)
+        except redis.exceptions.ResponseError:
+            pass
+        last_id = '0'
+        while True:
+            try:
+                if last_id == '>':
+                    claimed = self._database.xautoclaim(
+                        CHECKOUT_STREAM, CHECKOUT_GROUP, consumer,
+                        self.claim_after, count=self.batch_size)
+                    if claimed[1]:
+                        self.process(claimed[1])
+                replies = self._database.xreadgroup(
+                    CHECKOUT_GROUP, consumer, {CHECKOUT_STREAM: last_id},
+                    count=self.batch_size, block=5000)
+                entries = replies[0][1] if replies else []
+                if last_id == '0' and not entries:
+                    last_id = '>'
+                    continue
+                if entries:
+                    self.process(entries)
+            except Exception as err:
+                logger.warning(f'Ошибка в очереди заказов\n{err}\n')
+                time.sleep(self.backoff_factor)
+
+    def start(self, workers: int = 1, consumer: str = None) -> None:
+        consumer = consumer or socket.gethostname()
+        for number in range(workers):
+            thread = threading.Thread(target=self.run,
+                                      args=(f'{consumer}-{number}',),
+                                      daemon=True)
+            thread.start()
@@ -0,0 +1,84 @@
+import argparse
+import itertools
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+_update_ids = itertools.count(1)
+
+
+def make_message_update(chat_id: int, text: str) -> dict:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'}
+    message = {
+        'message_id': random.randint(1, 10 ** 6),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': user,
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text)}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def make_callback_update(chat_id: int, data: str,
+                         message: dict = None) -> dict:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'}
+    message = message or {
+        'message_id': random.randint(1, 10 ** 6),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot'},
+        'text': 'Пожалуйста, выберите товар!',
+    }
+    callback_query = {'id': str(next(_update_ids)), 'from': user,
+                      'chat_instance': str(chat_id), 'message': message,
+                      'data': data}
+    return {'update_id': next(_update_ids), 'callback_query': callback_query}
+
+
+def post_update(url: str, update: dict, secret: str) -> int:
+    request = Request(url, data=json.dumps(update).encode(),
+                      headers={'Content-Type': 'application/json',
+                               'X-Telegram-Bot-Api-Secret-Token': secret})
+    with urlopen(request) as response:
+        return response.status
+
+
+def simulate_chat(url: str, secret: str, chat_id: int,
+                  presses: int) -> None:
+    post_update(url, make_message_update(chat_id, '/start'), secret)
+    for page in range(presses):
+        post_update(url, make_callback_update(chat_id, str(page + 1)),
+                    secret)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Отправляет выдуманные обновления Telegram на webhook'
+    )
+    parser.add_argument('url', help='адрес webhook, например '
+                        'http://localhost:8443/telegram')
+    parser.add_argument('--secret', required=True,
+                        help='значение WEBHOOK_SECRET приёмника')
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--presses', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for chat_id in range(1, args.chats + 1):
+            executor.submit(simulate_chat, args.url, args.secret, chat_id,
+                            args.presses)
+    elapsed = time.monotonic() - started_at
+    updates = args.chats * (args.presses + 1)
+    print(f'Отправлено {updates} обновлений за {elapsed:.2f} с '
+          f'({updates / elapsed:.0f} в секунду)')
+
+
+if __name__ == '__main__':
+    main()
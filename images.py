@@ -0,0 +1,240 @@
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+import metrics
+from moltin_api import get_product_image, get_product_image_link
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_PHOTO_SIDE = 1280
+
+
+class TelegramFileIdCache:
+    """Соответствие id картинки в Elasticpath и `file_id` уже загруженной
+    в Telegram фотографии. Хранится в Redis, чтобы переживать перезапуски
+    бота, и дублируется в памяти процесса: `file_id` не меняется."""
+
+    def __init__(self, database, key: str = 'telegram_file_ids'):
+        self._database = database
+        self._key = key
+        self._file_ids = {}
+
+    def get(self, image_id: str):
+        file_id = self._file_ids.get(image_id)
+        if file_id:
+            metrics.count_cache_lookup('file_ids', 'hit')
+            return file_id
+        file_id = self._database.hget(self._key, image_id)
+        if file_id:
+            file_id = file_id.decode('utf-8')
+            self._file_ids[image_id] = file_id
+        metrics.count_cache_lookup('file_ids', 'hit' if file_id else 'miss')
+        return file_id
+
+    def set(self, image_id: str, file_id: str) -> None:
+        self._file_ids[image_id] = file_id
+        self._database.hset(self._key, image_id, file_id)
+
+    def forget(self, image_id: str) -> None:
+        self._file_ids.pop(image_id, None)
+        self._database.hdel(self._key, image_id)
+
+
+class ImageDiskCache:
+    """Картинки товаров на диске бота.
+
+    Файл в Elasticpath с тем же id не меняется, поэтому картинка
+    хранится под хэшем своего id и не требует проверки свежести. Общий
+    размер каталога ограничен `max_bytes`: при переполнении удаляются
+    картинки, которые дольше всего не отправлялись. Картинка скачивается
+    потоком во временный файл и, если установлен Pillow, уменьшается до
+    `max_side` точек по большей стороне — больше Telegram всё равно не
+    показывает. Читается картинка через `mmap`, не копируясь в память.
+    """
+
+    def __init__(self, directory: str, max_bytes: int,
+                 max_side: int = TELEGRAM_PHOTO_SIDE, quality: int = 85,
+                 prefetch_workers: int = 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_side = max_side if Image else 0
+        self.quality = quality
+        self._sizes = OrderedDict()
+        self._total_size = 0
+        self._guard = threading.Lock()
+        self._downloading = {}
+        self._prefetch = ThreadPoolExecutor(max_workers=prefetch_workers)
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._sizes[name] = size
+            self._total_size += size
+        self._evict()
+
+    @staticmethod
+    def _name(image_id: str) -> str:
+        return hashlib.sha256(image_id.encode('utf-8')).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __contains__(self, image_id: str) -> bool:
+        return self._name(image_id) in self._sizes
+
+    def _touch(self, name: str) -> bool:
+        with self._guard:
+            if name not in self._sizes:
+                return False
+            self._sizes.move_to_end(name)
+        try:
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            self._forget(name)
+            return False
+        return True
+
+    def _forget(self, name: str) -> None:
+        with self._guard:
+            size = self._sizes.pop(name, None)
+            if size is not None:
+                self._total_size -= size
+
+    def _evict(self) -> None:
+        while True:
+            with self._guard:
+                if self._total_size <= self.max_bytes or not self._sizes:
+                    return
+                name, size = self._sizes.popitem(last=False)
+                self._total_size -= size
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def _downscale(self, path: str) -> None:
+        with Image.open(path) as image:
+            if max(image.size) <= self.max_side:
+                return
+            image.thumbnail((self.max_side, self.max_side))
+            image = image.convert('RGB')
+            image.save(path, format='JPEG', quality=self.quality,
+                       optimize=True)
+
+    def _download(self, store_access_token: str, image_id: str,
+                  name: str) -> None:
+        descriptor, temp_path = tempfile.mkstemp(prefix='.',
+                                                 dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as temp_file:
+                image = get_product_image(store_access_token, image_id)
+                image.decode_content = True
+                shutil.copyfileobj(image, temp_file)
+            if self.max_side:
+                self._downscale(temp_path)
+            os.replace(temp_path, self._path(name))
+        except Exception:
+            os.remove(temp_path)
+            raise
+        size = os.path.getsize(self._path(name))
+        with self._guard:
+            self._sizes[name] = size
+            self._total_size += size
+        self._evict()
+
+    def fetch(self, store_access_token: str, image_id: str) -> None:
+        name = self._name(image_id)
+        if self._touch(name):
+            metrics.count_cache_lookup('images', 'hit')
+            return
+        metrics.count_cache_lookup('images', 'miss')
+        with self._guard:
+            download = self._downloading.get(name)
+            is_leader = download is None
+            if is_leader:
+                download = self._downloading[name] = threading.Lock()
+                download.acquire()
+        if not is_leader:
+            with download:
+                return
+        try:
+            if not self._touch(name):
+                self._download(store_access_token, image_id, name)
+        finally:
+            with self._guard:
+                del self._downloading[name]
+            download.release()
+
+    def prefetch(self, store_access_token: str, image_ids) -> None:
+        for image_id in image_ids:
+            if image_id and image_id not in self:
+                self._prefetch.submit(self._prefetch_one, store_access_token,
+                                      image_id)
+
+    def _prefetch_one(self, store_access_token: str, image_id: str) -> None:
+        try:
+            self.fetch(store_access_token, image_id)
+        except Exception as err:
+            logger.warning(f'Не удалось скачать картинку {image_id}\n{err}\n')
+
+    @contextmanager
+    def open(self, store_access_token: str, image_id: str):
+        name = self._name(image_id)
+        self.fetch(store_access_token, image_id)
+        try:
+            image_file = open(self._path(name), 'rb')
+        except FileNotFoundError:
+            self._forget(name)
+            self.fetch(store_access_token, image_id)
+            image_file = open(self._path(name), 'rb')
+        with image_file, mmap.mmap(image_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ) as image:
+            yield image
+
+
+def send_product_photo(bot: Bot, file_ids: TelegramFileIdCache,
+                       store_access_token: str, image_id: str,
+                       disk_cache: ImageDiskCache = None,
+                       **kwargs) -> Message:
+    file_id = file_ids.get(image_id)
+    if file_id:
+        try:
+            return bot.send_photo(photo=file_id, **kwargs)
+        except BadRequest as err:
+            logger.warning(f'Telegram не принял file_id {file_id}\n{err}\n')
+            file_ids.forget(image_id)
+    if disk_cache is not None:
+        with disk_cache.open(store_access_token, image_id) as image:
+            message = bot.send_photo(photo=image, **kwargs)
+        file_ids.set(image_id, message.photo[-1].file_id)
+        return message
+    image_link = get_product_image_link(store_access_token, image_id)
+    try:
+        message = bot.send_photo(photo=image_link, **kwargs)
+    except BadRequest:
+        image = get_product_image(store_access_token, image_id)
+        message = bot.send_photo(photo=image, **kwargs)
+    file_ids.set(image_id, message.photo[-1].file_id)
+    return message
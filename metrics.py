@@ -0,0 +1,293 @@
+import logging
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import redis
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROUNDTRIP_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+SIZE_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+ID_PATTERN = re.compile(
+    r'/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)'
+    r'(?=/|$)'
+)
+
+_registry = []
+_trace_sample_rate = 0.0
+_trace = ContextVar('trace', default=None)
+_redis_roundtrips = ContextVar('redis_roundtrips', default=None)
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, **extra) -> str:
+    labels = dict(zip(labelnames, labelvalues), **extra)
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in labels.items())
+    return f'{{{pairs}}}'
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def totals(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}{labels} {value}')
+        return lines
+
+
+class Gauge:
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._value = 0
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def render(self) -> list:
+        with self._lock:
+            value = self._value
+        return [f'# HELP {self.name} {self.documentation}',
+                f'# TYPE {self.name} gauge',
+                f'{self.name} {value}']
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bucket] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def totals(self) -> dict:
+        with self._lock:
+            return {key: (sum(counts), total)
+                    for key, (counts, total) in self._values.items()}
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = {key: (list(counts), total)
+                      for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            bounds = [*map(str, self.buckets), '+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, le=bound)
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+HANDLER_SECONDS = Histogram(
+    'bot_update_seconds',
+    'Время обработки обновления по состояниям бота', ('state',))
+UPDATE_ERRORS = Counter(
+    'bot_update_errors_total',
+    'Обновления, обработка которых завершилась ошибкой',
+    ('state', 'reason'))
+REDIS_ROUNDTRIPS = Histogram(
+    'bot_redis_roundtrips',
+    'Число обращений к Redis за одно обновление', ('state',),
+    buckets=ROUNDTRIP_BUCKETS)
+UPSTREAM_SECONDS = Histogram(
+    'moltin_request_seconds',
+    'Время запроса к Elasticpath', ('method', 'endpoint'))
+UPSTREAM_RESPONSES = Counter(
+    'moltin_responses_total',
+    'Ответы Elasticpath по кодам', ('method', 'endpoint', 'status'))
+UPSTREAM_RETRIES = Counter(
+    'moltin_retries_total',
+    'Повторные запросы к Elasticpath', ('endpoint', 'reason'))
+CACHE_LOOKUPS = Counter(
+    'bot_cache_lookups_total',
+    'Обращения к кэшам бота', ('cache', 'result'))
+SESSION_BYTES = Histogram(
+    'bot_session_bytes',
+    'Размер сессии чата в Redis при записи, байт', buckets=SIZE_BUCKETS)
+SESSION_CACHE_ENTRIES = Gauge(
+    'bot_session_cache_entries',
+    'Число сессий чатов в памяти процесса')
+SESSION_CACHE_BYTES = Gauge(
+    'bot_session_cache_bytes',
+    'Размер сессий чатов в памяти процесса, байт')
+TELEGRAM_CALLS = Counter(
+    'telegram_calls_total',
+    'Запросы из очереди отправки в Telegram по результату', ('result',))
+TELEGRAM_QUEUE_SECONDS = Histogram(
+    'telegram_queue_seconds',
+    'Время ожидания запроса в очереди отправки в Telegram')
+
+
+def get_endpoint(url: str) -> str:
+    return ID_PATTERN.sub('/{id}', urlsplit(url).path)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def count_cache_lookup(cache: str, result: str) -> None:
+    CACHE_LOOKUPS.inc(cache=cache, result=result)
+
+
+def count_redis_roundtrip() -> None:
+    roundtrips = _redis_roundtrips.get()
+    if roundtrips is not None:
+        roundtrips[0] += 1
+
+
+class UpdateMetrics:
+
+    def __init__(self):
+        self.state = 'UNKNOWN'
+
+
+@contextmanager
+def track_update():
+    """Замеряет обработку одного обновления: время, число обращений к
+    Redis и, для доли `trace_sample_rate` обновлений, трассировку."""
+    update_metrics = UpdateMetrics()
+    roundtrips = [0]
+    started_at = time.perf_counter()
+    is_sampled = random.random() < _trace_sample_rate
+    trace = (started_at, []) if is_sampled else None
+    roundtrips_token = _redis_roundtrips.set(roundtrips)
+    trace_token = _trace.set(trace)
+    try:
+        yield update_metrics
+    finally:
+        elapsed = time.perf_counter() - started_at
+        _redis_roundtrips.reset(roundtrips_token)
+        _trace.reset(trace_token)
+        HANDLER_SECONDS.observe(elapsed, state=update_metrics.state)
+        REDIS_ROUNDTRIPS.observe(roundtrips[0], state=update_metrics.state)
+        if trace is not None:
+            spans = ', '.join(f'{name} +{start * 1000:.0f}мс '
+                              f'{duration * 1000:.0f}мс'
+                              for name, start, duration in trace[1])
+            logger.info(f'Трассировка {update_metrics.state} '
+                        f'{elapsed * 1000:.0f}мс: {spans}')
+
+
+@contextmanager
+def span(name: str):
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace_started_at, spans = trace
+        spans.append((name, started_at - trace_started_at,
+                      time.perf_counter() - started_at))
+
+
+class CountingConnection(redis.Connection):
+
+    def send_packed_command(self, command, check_health: bool = True):
+        count_redis_roundtrip()
+        super().send_packed_command(command, check_health)
+
+
+class AsyncCountingConnection(aioredis.Connection):
+
+    async def send_packed_command(self, command, check_health: bool = True):
+        count_redis_roundtrip()
+        await super().send_packed_command(command, check_health)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def configure(port: int = 0, host: str = '0.0.0.0',
+              trace_sample_rate: float = 0) -> None:
+    global _trace_sample_rate
+    _trace_sample_rate = trace_sample_rate
+    if not port:
+        return
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f'Метрики доступны на порту {port}')
@@ -0,0 +1,32 @@
+import logging
+
+from environs import Env
+
+from bot import get_database_connection
+from session import configure_sessions, migrate_legacy_sessions
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    env = Env()
+    env.read_env()
+    database_password = env.str("REDIS_PASSWORD")
+    database_host = env.str("REDIS_HOST")
+    database_port = env.int("REDIS_PORT")
+    session_ttl = env.int('SESSION_TTL', 30 * 24 * 60 * 60)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logger.setLevel(logging.INFO)
+
+    database = get_database_connection(database_password, database_host,
+                                       database_port)
+    configure_sessions(ttl=session_ttl)
+    migrated = migrate_legacy_sessions(database)
+    logger.info(f'Перенесено чатов со старыми ключами: {migrated}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,407 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+API_URL = 'https://api.moltin.com'
+
+PRIORITY_AUTH = 0
+PRIORITY_CHECKOUT = 1
+PRIORITY_CART_WRITE = 2
+PRIORITY_CART_READ = 3
+PRIORITY_CATALOG = 4
+
+_client = None
+
+
+class _InFlightCall:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class UpstreamScheduler:
+    """Очередь запросов к api.moltin.com.
+
+    Ограничивает частоту запросов «ведром токенов» (`rate` запросов в
+    секунду, не больше `burst` подряд), пропускает запросы в порядке
+    приоритета, склеивает одинаковые одновременные GET-запросы в один
+    и приостанавливает все запросы на время из заголовка `Retry-After`.
+    При превышении лимита запросы ждут своей очереди, а не падают.
+    """
+
+    def __init__(self, rate: float = 0, burst: int = 10):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if not self.rate:
+            self._tokens = float(self.burst)
+            return
+        elapsed = now - self._updated_at
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def acquire(self, priority: int) -> None:
+        with self._condition:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self._paused_until:
+                        timeout = self._paused_until - now
+                    elif self._waiting[0] != ticket:
+                        timeout = None
+                    elif self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    else:
+                        timeout = (1 - self._tokens) / self.rate
+                    self._condition.wait(timeout)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        with self._condition:
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + seconds)
+            self._condition.notify_all()
+
+    def coalesce(self, key, send) -> requests.Response:
+        with self._in_flight_lock:
+            call = self._in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._in_flight[key] = _InFlightCall()
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.response
+        try:
+            call.response = send()
+            return call.response
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            call.done.set()
+
+
+class MoltinClient:
+    """Клиент api.moltin.com поверх общего `requests.Session`.
+
+    Соединения переиспользуются из пула размером `pool_size`, запросы
+    на чтение и удаление повторяются при ответах 5xx.
+    """
+
+    def __init__(self, pool_size: int = 10, timeout: float = 10,
+                 retries: int = 3, backoff_factor: float = 0.5,
+                 token_manager=None, scheduler: UpstreamScheduler = None,
+                 rate_limit_retries: int = 5, page_limit: int = 100,
+                 page_concurrency: int = 4):
+        self.timeout = timeout
+        self.page_limit = page_limit
+        self.page_concurrency = page_concurrency
+        self.token_manager = token_manager
+        self.scheduler = scheduler or UpstreamScheduler()
+        self.rate_limit_retries = rate_limit_retries
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, path: str, store_access_token: str = None,
+                priority: int = PRIORITY_CATALOG,
+                **kwargs) -> requests.Response:
+        if path.startswith('http'):
+            url, is_api_call = path, False
+        else:
+            url, is_api_call = f'{API_URL}{path}', True
+        headers = kwargs.pop('headers', {})
+        if store_access_token:
+            headers['Authorization'] = f'Bearer {store_access_token}'
+        kwargs.setdefault('timeout', self.timeout)
+
+        def send() -> requests.Response:
+            return self._send(method, url, headers, priority, is_api_call,
+                              **kwargs)
+
+        if method == 'GET' and is_api_call and not kwargs.get('stream'):
+            params = tuple(sorted(kwargs.get('params', {}).items()))
+            key = (url, params, headers.get('Authorization'))
+            response = self.scheduler.coalesce(key, send)
+        else:
+            response = send()
+        response.raise_for_status()
+        return response
+
+    def _send(self, method: str, url: str, headers: dict, priority: int,
+              is_api_call: bool, **kwargs) -> requests.Response:
+        endpoint = metrics.get_endpoint(url) if is_api_call else 'cdn'
+        token_refreshed = False
+        for _ in range(self.rate_limit_retries + 1):
+            if is_api_call:
+                self.scheduler.acquire(priority)
+            response = self._timed_request(method, url, endpoint, headers,
+                                           **kwargs)
+            if response.status_code == 429:
+                metrics.UPSTREAM_RETRIES.inc(endpoint=endpoint,
+                                             reason='rate_limit')
+                retry_after = response.headers.get('Retry-After', '1')
+                self.scheduler.pause(float(retry_after)
+                                     if retry_after.isdigit() else 1)
+                continue
+            authorization = headers.get('Authorization')
+            if response.status_code == 401 and authorization \
+                    and self.token_manager and not token_refreshed:
+                metrics.UPSTREAM_RETRIES.inc(endpoint=endpoint,
+                                             reason='token')
+                token_refreshed = True
+                store_access_token = self.token_manager.refresh(
+                    stale_token=authorization.removeprefix('Bearer '))
+                headers['Authorization'] = f'Bearer {store_access_token}'
+                continue
+            break
+        return response
+
+    def _timed_request(self, method: str, url: str, endpoint: str,
+                       headers: dict, **kwargs) -> requests.Response:
+        try:
+            with metrics.span(f'{method} {endpoint}'), \
+                    metrics.UPSTREAM_SECONDS.time(method=method,
+                                                  endpoint=endpoint):
+                response = self.session.request(method, url, headers=headers,
+                                                **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.UPSTREAM_RESPONSES.inc(method=method, endpoint=endpoint,
+                                           status='error')
+            raise
+        metrics.UPSTREAM_RESPONSES.inc(method=method, endpoint=endpoint,
+                                       status=response.status_code)
+        retries = getattr(response.raw, 'retries', None)
+        if retries and retries.history:
+            metrics.UPSTREAM_RETRIES.inc(len(retries.history),
+                                         endpoint=endpoint,
+                                         reason='server_error')
+        return response
+
+    def fetch_access_token(self, client_secret: str, client_id: str) -> dict:
+        data = {'grant_type': 'client_credentials',
+                'client_secret': client_secret, 'client_id': client_id}
+        response = self.request('POST', '/oauth/access_token',
+                                priority=PRIORITY_AUTH, data=data)
+        return response.json()
+
+    def get_access_token(self, client_secret: str, client_id: str) -> str:
+        access_token = self.fetch_access_token(client_secret, client_id)
+        return access_token.get('access_token')
+
+    def iter_pages(self, store_access_token: str, path: str):
+        """Отдаёт записи списка Elasticpath постранично, по порядку.
+
+        Если в ответе на первую страницу указано общее число записей,
+        остальные страницы запрашиваются параллельно, иначе — по одной,
+        пока не придёт неполная страница.
+        """
+        def fetch_page(offset: int) -> dict:
+            params = {'page[limit]': self.page_limit, 'page[offset]': offset}
+            response = self.request('GET', path, store_access_token,
+                                    params=params)
+            return response.json()
+
+        first_page = fetch_page(0)
+        records = first_page.get('data')
+        yield records
+        total = (first_page.get('meta') or {}).get('results', {}).get('total')
+        if total is not None:
+            offsets = range(self.page_limit, total, self.page_limit)
+            with ThreadPoolExecutor(self.page_concurrency) as executor:
+                for page in executor.map(fetch_page, offsets):
+                    yield page.get('data')
+            return
+        offset = 0
+        while len(records) == self.page_limit:
+            offset += self.page_limit
+            records = fetch_page(offset).get('data')
+            yield records
+
+    def iter_catalog_products(self, store_access_token: str):
+        return self.iter_pages(store_access_token, '/catalog/products')
+
+    def iter_inventories(self, store_access_token: str):
+        return self.iter_pages(store_access_token, '/v2/inventories')
+
+    def iter_categories(self, store_access_token: str):
+        return self.iter_pages(store_access_token, '/v2/categories')
+
+    def get_catalog_products(self, store_access_token: str) -> list:
+        return [raw_product for raw_products
+                in self.iter_catalog_products(store_access_token)
+                for raw_product in raw_products]
+
+    def get_inventories(self, store_access_token: str) -> list:
+        return [inventory for inventories
+                in self.iter_inventories(store_access_token)
+                for inventory in inventories]
+
+    def get_product_stock(self, store_access_token: str,
+                          product_id: str) -> int:
+        response = self.request('GET', f'/v2/inventories/{product_id}',
+                                store_access_token)
+        return response.json().get('data').get('available')
+
+    def get_product_image_link(self, store_access_token: str,
+                               image_id: str) -> str:
+        response = self.request('GET', f'/v2/files/{image_id}',
+                                store_access_token)
+        return response.json().get('data').get('link').get('href')
+
+    def get_product_image(self, store_access_token: str, image_id: str):
+        image_link = self.get_product_image_link(store_access_token,
+                                                 image_id)
+        response = self.request('GET', image_link, stream=True)
+        return response.raw
+
+    def put_product_in_cart(self, store_access_token: str, product_id: str,
+                            quantity: str, chat_id: int) -> dict:
+        body = {"data": {'quantity': quantity, 'type': 'cart_item',
+                         'id': product_id}}
+        response = self.request('POST', f'/v2/carts/{chat_id}/items',
+                                store_access_token,
+                                priority=PRIORITY_CART_WRITE, json=body)
+        return response.json()
+
+    def get_user_cart(self, store_access_token: str, chat_id: int) -> dict:
+        response = self.request('GET', f'/v2/carts/{chat_id}/items',
+                                store_access_token,
+                                priority=PRIORITY_CART_READ)
+        return response.json()
+
+    def delete_cart_product(self, store_access_token: str, chat_id: int,
+                            product_id: str,
+                            priority: int = PRIORITY_CART_WRITE) -> dict:
+        response = self.request('DELETE',
+                                f'/v2/carts/{chat_id}/items/{product_id}',
+                                store_access_token, priority=priority)
+        return response.json()
+
+    def delete_all_cart_products(self, store_access_token: str,
+                                 chat_id: int) -> None:
+        self.request('DELETE', f'/v2/carts/{chat_id}/items',
+                     store_access_token, priority=PRIORITY_CHECKOUT)
+
+    def create_customer(self, store_access_token: str, customer_name: str,
+                        customer_email: str) -> str:
+        body = {"data": {'name': customer_name, 'type': 'customer',
+                         'email': customer_email}}
+        response = self.request('POST', '/v2/customers', store_access_token,
+                                priority=PRIORITY_CHECKOUT, json=body)
+        return response.json().get('data').get('id')
+
+
+def configure_client(**kwargs) -> MoltinClient:
+    global _client
+    _client = MoltinClient(**kwargs)
+    return _client
+
+
+def get_client() -> MoltinClient:
+    global _client
+    if _client is None:
+        _client = MoltinClient()
+    return _client
+
+
+def fetch_access_token(client_secret: str, client_id: str) -> dict:
+    return get_client().fetch_access_token(client_secret, client_id)
 
 
 def get_access_token(client_secret: str, client_id: str) -> str:
-    url = 'https://api.moltin.com/oauth/access_token'
-    data = {'grant_type': 'client_credentials',
-            'client_secret': client_secret, 'client_id': client_id}
-    response = requests.post(url, data=data)
-    response.raise_for_status()
-    access_token = response.json().get('access_token')
-    return access_token
-
-
-def get_products(store_access_token: str) -> tuple[list, list]:
-    headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get('https://api.moltin.com/catalog/products',
-                            headers=headers)
-    response.raise_for_status()
-    raw_products = response.json().get('data')
-    response = requests.get('https://api.moltin.com/v2/inventories',
-                            headers=headers)
-    response.raise_for_status()
-    inventories = response.json().get('data')
-    return raw_products, inventories
+    return get_client().get_access_token(client_secret, client_id)
+
+
+def iter_catalog_products(store_access_token: str):
+    return get_client().iter_catalog_products(store_access_token)
+
+
+def iter_inventories(store_access_token: str):
+    return get_client().iter_inventories(store_access_token)
+
+
+def iter_categories(store_access_token: str):
+    return get_client().iter_categories(store_access_token)
+
+
+def get_catalog_products(store_access_token: str) -> list:
+    return get_client().get_catalog_products(store_access_token)
+
+
+def get_inventories(store_access_token: str) -> list:
+    return get_client().get_inventories(store_access_token)
+
+
+def get_product_stock(store_access_token: str, product_id: str) -> int:
+    return get_client().get_product_stock(store_access_token, product_id)
+
+
+def get_product_image_link(store_access_token: str, image_id: str) -> str:
+    return get_client().get_product_image_link(store_access_token, image_id)
 
 
 def get_product_image(store_access_token: str, image_id: str):
-    headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get(f'https://api.moltin.com/v2/files/{image_id}',
-                            headers=headers)
-    response.raise_for_status()
-    image_link = response.json().get('data').get('link').get('href')
-    response = requests.get(image_link, stream=True)
-    response.raise_for_status()
-    return response.raw
+    return get_client().get_product_image(store_access_token, image_id)
 
 
 def put_product_in_cart(store_access_token: str, product_id: str,
-                        quantity: str, chat_id: int) -> int:
-    url = f'https://api.moltin.com/v2/carts/{chat_id}/items'
-    headers = {'Authorization': f'Bearer {store_access_token}'}
-    body = {"data": {'quantity': quantity, 'type': 'cart_item',
-                     'id': product_id}}
-    response = requests.post(url, headers=headers, json=body)
-    response.raise_for_status()
-    return response.json()
+                        quantity: str, chat_id: int) -> dict:
+    return get_client().put_product_in_cart(store_access_token, product_id,
+                                            quantity, chat_id)
 
 
 def get_user_cart(store_access_token: str, chat_id: int) -> dict:
-    url = f'https://api.moltin.com/v2/carts/{chat_id}/items'
-    headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_client().get_user_cart(store_access_token, chat_id)
 
 
 def delete_cart_product(store_access_token: str, chat_id: int,
-                        product_id: str) -> None:
-    url = f'https://api.moltin.com/v2/carts/{chat_id}/items/{product_id}'
-    headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+                        product_id: str,
+                        priority: int = PRIORITY_CART_WRITE) -> dict:
+    return get_client().delete_cart_product(store_access_token, chat_id,
+                                            product_id, priority)
 
 
 def delete_all_cart_products(store_access_token: str, chat_id: int) -> None:
-    url = f'https://api.moltin.com/v2/carts/{chat_id}/items'
-    headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+    get_client().delete_all_cart_products(store_access_token, chat_id)
 
 
 def create_customer(store_access_token: str, customer_name: str,
                     customer_email: str) -> str:
-    url = 'https://api.moltin.com/v2/customers'
-    headers = {'Authorization': f'Bearer {store_access_token}'}
-    body = {"data": {'name': customer_name, 'type': 'customer',
-                     'email': customer_email}}
-    response = requests.post(url, headers=headers, json=body)
-    response.raise_for_status()
-    customer_id = response.json().get('data').get('id')
-    return customer_id
+    return get_client().create_customer(store_access_token, customer_name,
+                                        customer_email)
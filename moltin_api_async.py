@@ -0,0 +1,246 @@
+import asyncio
+
+import httpx
+
+import metrics
+from moltin_api import API_URL
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_METHODS = ('GET', 'DELETE')
+
+_client = None
+
+
+class AsyncMoltinClient:
+    """Асинхронный клиент api.moltin.com поверх общего `httpx.AsyncClient`.
+
+    Повторяет те же запросы, что и `moltin_api.MoltinClient`, и должен
+    использоваться внутри одного цикла событий.
+    """
+
+    def __init__(self, pool_size: int = 100, timeout: float = 10,
+                 retries: int = 3, backoff_factor: float = 0.5,
+                 token_manager=None, page_limit: int = 100):
+        self.retries = retries
+        self.page_limit = page_limit
+        self.token_manager = token_manager
+        self.backoff_factor = backoff_factor
+        limits = httpx.Limits(max_connections=pool_size,
+                              max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(base_url=API_URL, limits=limits,
+                                        timeout=timeout)
+
+    async def request(self, method: str, path: str,
+                      store_access_token: str = None,
+                      **kwargs) -> httpx.Response:
+        if store_access_token:
+            headers = kwargs.setdefault('headers', {})
+            headers['Authorization'] = f'Bearer {store_access_token}'
+        endpoint = 'cdn' if path.startswith('http') \
+            else metrics.get_endpoint(path)
+        token_refreshed = False
+        for attempt in range(self.retries + 1):
+            response = await self._timed_request(method, path, endpoint,
+                                                 **kwargs)
+            if response.status_code == 401 and store_access_token \
+                    and self.token_manager and not token_refreshed:
+                metrics.UPSTREAM_RETRIES.inc(endpoint=endpoint,
+                                             reason='token')
+                token_refreshed = True
+                store_access_token = await asyncio.to_thread(
+                    self.token_manager.refresh, stale_token=store_access_token)
+                kwargs['headers']['Authorization'] = \
+                    f'Bearer {store_access_token}'
+                response = await self._timed_request(method, path, endpoint,
+                                                     **kwargs)
+            if response.status_code not in RETRY_STATUSES \
+                    or method not in RETRY_METHODS \
+                    or attempt == self.retries:
+                break
+            reason = 'rate_limit' if response.status_code == 429 \
+                else 'server_error'
+            metrics.UPSTREAM_RETRIES.inc(endpoint=endpoint, reason=reason)
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+        response.raise_for_status()
+        return response
+
+    async def _timed_request(self, method: str, path: str, endpoint: str,
+                             **kwargs) -> httpx.Response:
+        try:
+            with metrics.span(f'{method} {endpoint}'), \
+                    metrics.UPSTREAM_SECONDS.time(method=method,
+                                                  endpoint=endpoint):
+                response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            metrics.UPSTREAM_RESPONSES.inc(method=method, endpoint=endpoint,
+                                           status='error')
+            raise
+        metrics.UPSTREAM_RESPONSES.inc(method=method, endpoint=endpoint,
+                                       status=response.status_code)
+        return response
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def get_access_token(self, client_secret: str,
+                               client_id: str) -> str:
+        data = {'grant_type': 'client_credentials',
+                'client_secret': client_secret, 'client_id': client_id}
+        response = await self.request('POST', '/oauth/access_token',
+                                      data=data)
+        return response.json().get('access_token')
+
+    async def iter_pages(self, store_access_token: str, path: str):
+        async def fetch_page(offset: int) -> dict:
+            params = {'page[limit]': self.page_limit, 'page[offset]': offset}
+            response = await self.request('GET', path, store_access_token,
+                                          params=params)
+            return response.json()
+
+        first_page = await fetch_page(0)
+        records = first_page.get('data')
+        yield records
+        total = (first_page.get('meta') or {}).get('results', {}).get('total')
+        if total is not None:
+            offsets = range(self.page_limit, total, self.page_limit)
+            pages = await asyncio.gather(*map(fetch_page, offsets))
+            for page in pages:
+                yield page.get('data')
+            return
+        offset = 0
+        while len(records) == self.page_limit:
+            offset += self.page_limit
+            records = (await fetch_page(offset)).get('data')
+            yield records
+
+    async def get_catalog_products(self, store_access_token: str) -> list:
+        return [raw_product async for raw_products
+                in self.iter_pages(store_access_token, '/catalog/products')
+                for raw_product in raw_products]
+
+    async def get_inventories(self, store_access_token: str) -> list:
+        return [inventory async for inventories
+                in self.iter_pages(store_access_token, '/v2/inventories')
+                for inventory in inventories]
+
+    async def get_product_stock(self, store_access_token: str,
+                                product_id: str) -> int:
+        response = await self.request('GET', f'/v2/inventories/{product_id}',
+                                      store_access_token)
+        return response.json().get('data').get('available')
+
+    async def get_product_image_link(self, store_access_token: str,
+                                     image_id: str) -> str:
+        response = await self.request('GET', f'/v2/files/{image_id}',
+                                      store_access_token)
+        return response.json().get('data').get('link').get('href')
+
+    async def get_product_image(self, store_access_token: str,
+                                image_id: str) -> bytes:
+        image_link = await self.get_product_image_link(store_access_token,
+                                                       image_id)
+        response = await self.request('GET', image_link)
+        return response.content
+
+    async def put_product_in_cart(self, store_access_token: str,
+                                  product_id: str, quantity: str,
+                                  chat_id: int) -> dict:
+        body = {"data": {'quantity': quantity, 'type': 'cart_item',
+                         'id': product_id}}
+        response = await self.request('POST', f'/v2/carts/{chat_id}/items',
+                                      store_access_token, json=body)
+        return response.json()
+
+    async def get_user_cart(self, store_access_token: str,
+                            chat_id: int) -> dict:
+        response = await self.request('GET', f'/v2/carts/{chat_id}/items',
+                                      store_access_token)
+        return response.json()
+
+    async def delete_cart_product(self, store_access_token: str,
+                                  chat_id: int, product_id: str) -> dict:
+        response = await self.request(
+            'DELETE', f'/v2/carts/{chat_id}/items/{product_id}',
+            store_access_token)
+        return response.json()
+
+    async def delete_all_cart_products(self, store_access_token: str,
+                                       chat_id: int) -> None:
+        await self.request('DELETE', f'/v2/carts/{chat_id}/items',
+                           store_access_token)
+
+    async def create_customer(self, store_access_token: str,
+                              customer_name: str,
+                              customer_email: str) -> str:
+        body = {"data": {'name': customer_name, 'type': 'customer',
+                         'email': customer_email}}
+        response = await self.request('POST', '/v2/customers',
+                                      store_access_token, json=body)
+        return response.json().get('data').get('id')
+
+
+def configure_client(**kwargs) -> AsyncMoltinClient:
+    global _client
+    _client = AsyncMoltinClient(**kwargs)
+    return _client
+
+
+def get_client() -> AsyncMoltinClient:
+    global _client
+    if _client is None:
+        _client = AsyncMoltinClient()
+    return _client
+
+
+async def get_access_token(client_secret: str, client_id: str) -> str:
+    return await get_client().get_access_token(client_secret, client_id)
+
+
+async def get_catalog_products(store_access_token: str) -> list:
+    return await get_client().get_catalog_products(store_access_token)
+
+
+async def get_inventories(store_access_token: str) -> list:
+    return await get_client().get_inventories(store_access_token)
+
+
+async def get_product_stock(store_access_token: str, product_id: str) -> int:
+    return await get_client().get_product_stock(store_access_token,
+                                                product_id)
+
+
+async def get_product_image_link(store_access_token: str,
+                                 image_id: str) -> str:
+    return await get_client().get_product_image_link(store_access_token,
+                                                     image_id)
+
+
+async def get_product_image(store_access_token: str, image_id: str) -> bytes:
+    return await get_client().get_product_image(store_access_token, image_id)
+
+
+async def put_product_in_cart(store_access_token: str, product_id: str,
+                              quantity: str, chat_id: int) -> dict:
+    return await get_client().put_product_in_cart(
+        store_access_token, product_id, quantity, chat_id)
+
+
+async def get_user_cart(store_access_token: str, chat_id: int) -> dict:
+    return await get_client().get_user_cart(store_access_token, chat_id)
+
+
+async def delete_cart_product(store_access_token: str, chat_id: int,
+                              product_id: str) -> dict:
+    return await get_client().delete_cart_product(store_access_token,
+                                                  chat_id, product_id)
+
+
+async def delete_all_cart_products(store_access_token: str,
+                                   chat_id: int) -> None:
+    await get_client().delete_all_cart_products(store_access_token, chat_id)
+
+
+async def create_customer(store_access_token: str, customer_name: str,
+                          customer_email: str) -> str:
+    return await get_client().create_customer(store_access_token,
+                                              customer_name, customer_email)
@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _OutgoingCall:
+
+    def __init__(self, key, func, args: tuple, kwargs: dict, cost: int):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cost = cost
+        self.attempt = 0
+        self.enqueued_at = time.monotonic()
+
+
+class Outbox:
+    """Очередь исходящих запросов к Telegram.
+
+    Обработчики ставят запрос в очередь и сразу возвращаются, а
+    отправляют запросы `workers` фоновых потоков. Частота отправки
+    ограничивается «ведром токенов»: не больше `rate` сообщений в
+    секунду на всего бота и `chat_rate` в секунду, но не больше
+    `chat_burst` подряд, на один чат; `0` снимает ограничение. Запросы
+    с `cost=0` (ответы на нажатия, удаления) ограничением не учитываются.
+
+    Запросы одного чата отправляются строго по очереди. Запрос с тем же
+    `key`, что и ещё не отправленный запрос этого чата, заменяет его:
+    так из двух замен одного сообщения уходит только последняя. При
+    ошибке `RetryAfter` чат приостанавливается на указанное Telegram
+    время, а при сетевых ошибках запрос повторяется до `retries` раз.
+    """
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1,
+                 chat_burst: int = 3, workers: int = 8, retries: int = 3,
+                 backoff_factor: float = 1):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._queues = {}
+        self._busy = set()
+        self._ready = []
+        self._tickets = itertools.count()
+        self._arrivals = {}
+        self._paused_until = {}
+        self._arrival = 0.0
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        thread = threading.Thread(target=self._dispatch, daemon=True)
+        thread.start()
+
+    def put(self, chat_id: int, func, /, *args, key=None, cost: int = 1,
+            **kwargs) -> None:
+        """Ставит вызов `func(*args, **kwargs)` в очередь чата. `chat_id`
+        и `func` передаются только позиционно, чтобы не мешать
+        одноимённым аргументам методов `Bot`."""
+        with self._condition:
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+            if key is not None:
+                for call in queue:
+                    if call.key == key:
+                        call.func, call.args, call.kwargs = func, args, kwargs
+                        call.cost = max(call.cost, cost)
+                        metrics.TELEGRAM_CALLS.inc(result='merged')
+                        return
+            queue.append(_OutgoingCall(key, func, args, kwargs, cost))
+            if len(queue) == 1 and chat_id not in self._busy:
+                self._schedule(chat_id)
+
+    def wait(self, chat_id: int, timeout: float = None) -> bool:
+        """Ждёт, пока все запросы чата будут отправлены."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: chat_id not in self._queues, timeout)
+
+    def _get_ready_at(self, chat_id: int, call: _OutgoingCall) -> float:
+        ready_at = self._paused_until.get(chat_id, 0.0)
+        if call.cost and self.chat_rate:
+            tolerance = (self.chat_burst - 1) / self.chat_rate
+            ready_at = max(ready_at,
+                           self._arrivals.get(chat_id, 0.0) - tolerance)
+        if call.cost and self.rate:
+            tolerance = (self.rate - 1) / self.rate
+            ready_at = max(ready_at, self._arrival - tolerance)
+        return ready_at
+
+    def _schedule(self, chat_id: int) -> None:
+        call = self._queues[chat_id][0]
+        ready_at = self._get_ready_at(chat_id, call)
+        heapq.heappush(self._ready, (ready_at, next(self._tickets), chat_id))
+        self._condition.notify_all()
+
+    def _take(self, chat_id: int, call: _OutgoingCall, now: float) -> None:
+        if call.cost and self.chat_rate:
+            arrival = max(self._arrivals.get(chat_id, 0.0), now)
+            self._arrivals[chat_id] = arrival + call.cost / self.chat_rate
+        if call.cost and self.rate:
+            self._arrival = max(self._arrival, now) + call.cost / self.rate
+
+    def _dispatch(self) -> None:
+        with self._condition:
+            while True:
+                if not self._ready:
+                    self._condition.wait()
+                    continue
+                scheduled_at, _, chat_id = self._ready[0]
+                call = self._queues[chat_id][0]
+                ready_at = self._get_ready_at(chat_id, call)
+                now = time.monotonic()
+                if ready_at > scheduled_at:
+                    heapq.heapreplace(
+                        self._ready, (ready_at, next(self._tickets), chat_id))
+                    continue
+                if ready_at > now:
+                    self._condition.wait(ready_at - now)
+                    continue
+                heapq.heappop(self._ready)
+                self._queues[chat_id].popleft()
+                self._take(chat_id, call, now)
+                self._busy.add(chat_id)
+                metrics.TELEGRAM_QUEUE_SECONDS.observe(now - call.enqueued_at)
+                self._executor.submit(self._deliver, chat_id, call)
+
+    def _deliver(self, chat_id: int, call: _OutgoingCall) -> None:
+        result, delay = 'failed', 0
+        try:
+            call.func(*call.args, **call.kwargs)
+            result = 'sent'
+        except RetryAfter as err:
+            result, delay = 'retried', err.retry_after
+            logger.warning(f'Telegram просит подождать {delay} с перед '
+                           f'отправкой в чат {chat_id}')
+        except BadRequest as err:
+            logger.warning(f'Telegram отклонил запрос в чат {chat_id}\n'
+                           f'{err}\n')
+        except NetworkError as err:
+            if call.attempt < self.retries:
+                result = 'retried'
+                delay = self.backoff_factor * 2 ** call.attempt
+                call.attempt += 1
+            else:
+                logger.warning(f'Не удалось отправить запрос в чат '
+                               f'{chat_id}\n{err}\n')
+        except Exception as err:
+            logger.warning(f'Ошибка при отправке в чат {chat_id}\n{err}\n')
+        metrics.TELEGRAM_CALLS.inc(result=result)
+        with self._condition:
+            self._busy.discard(chat_id)
+            queue = self._queues[chat_id]
+            if result == 'retried':
+                queue.appendleft(call)
+                self._paused_until[chat_id] = time.monotonic() + delay
+            if queue:
+                self._schedule(chat_id)
+            else:
+                del self._queues[chat_id]
+                self._forget_idle(time.monotonic())
+                self._condition.notify_all()
+
+    def _forget_idle(self, now: float) -> None:
+        if len(self._arrivals) + len(self._paused_until) \
+                < 2 * len(self._queues) + 1024:
+            return
+        self._arrivals = {chat_id: arrival for chat_id, arrival
+                          in self._arrivals.items()
+                          if arrival > now or chat_id in self._queues}
+        self._paused_until = {chat_id: paused_until for chat_id, paused_until
+                              in self._paused_until.items()
+                              if paused_until > now}
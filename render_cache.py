@@ -0,0 +1,32 @@
+import threading
+
+import metrics
+
+
+class RenderCache:
+    """Готовые клавиатуры меню и карточки товаров.
+
+    Записи привязаны к версии каталога: как только каталог обновился,
+    все записи, собранные по старой версии, сбрасываются.
+    """
+
+    def __init__(self):
+        self._version = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, version: int, key: tuple, render):
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._entries = {}
+            entries = self._entries
+            if key in entries:
+                metrics.count_cache_lookup('render', 'hit')
+                return entries[key]
+        metrics.count_cache_lookup('render', 'miss')
+        rendered = render()
+        with self._lock:
+            if version == self._version:
+                entries[key] = rendered
+        return rendered
@@ -0,0 +1,156 @@
+import re
+import threading
+from bisect import bisect_left
+from collections.abc import Mapping
+
+WORD_PATTERN = re.compile(r'\w+')
+PRICE_FILTER_PATTERN = re.compile(r'^([<>])(\d+(?:[.,]\d+)?)$')
+NAME_WEIGHT = 3
+DESCRIPTION_WEIGHT = 1
+EXACT_MATCH_BONUS = 2
+
+
+def tokenize(text: str) -> list:
+    return WORD_PATTERN.findall((text or '').lower())
+
+
+def tokenize_category(text: str) -> tuple:
+    return tuple(tokenize((text or '').replace('_', ' ')))
+
+
+def is_category_match(category_words: tuple, query_words: tuple) -> bool:
+    return all(any(word.startswith(query_word) for word in category_words)
+               for query_word in query_words)
+
+
+def parse_query(text: str) -> dict:
+    """Разбирает поисковый запрос: слова ищутся по началу слов в
+    названии и описании товара, `<500` и `>100` ограничивают цену,
+    `#лосось` или `#красная_рыба` — категорию по началу слов её
+    названия."""
+    query = {'words': [], 'min_price': None, 'max_price': None,
+             'category': ()}
+    for part in (text or '').split():
+        price_filter = PRICE_FILTER_PATTERN.match(part)
+        if price_filter:
+            sign, price = price_filter.groups()
+            price_bound = 'max_price' if sign == '<' else 'min_price'
+            query[price_bound] = float(price.replace(',', '.'))
+        elif part.startswith('#') and len(part) > 1:
+            query['category'] = tokenize_category(part[1:])
+        else:
+            query['words'].extend(tokenize(part))
+    return query
+
+
+class SearchIndex:
+    """Поиск по каталогу без обращения к Elasticpath.
+
+    Обратный индекс `слово → {id товара: вес}` строится по названиям
+    и описаниям, а отсортированный словарь слов позволяет искать по
+    началу слова. Категории товара хранятся словами их названий из
+    `categories`. При обновлении каталога переиндексируются только
+    изменившиеся товары.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self._positions = {}
+        self._postings = {}
+        self._vocabulary = []
+        self._version = None
+        self._lock = threading.Lock()
+
+    def sync(self, version, products: Mapping, categories: Mapping) -> None:
+        with self._lock:
+            if version == self._version:
+                return
+            positions = {}
+            vocabulary_changed = False
+            for position, product_id in enumerate(products):
+                product = products[product_id]
+                document = (
+                    product.get('name'),
+                    product.get('description'),
+                    product.get('price'),
+                    tuple(tokenize_category(categories.get(category_id))
+                          for category_id in product.get('categories') or ()),
+                )
+                positions[product_id] = position
+                if self._documents.get(product_id) != document:
+                    self._remove(product_id)
+                    self._add(product_id, document)
+                    vocabulary_changed = True
+            for product_id in set(self._documents) - set(positions):
+                self._remove(product_id)
+                vocabulary_changed = True
+            if vocabulary_changed:
+                self._vocabulary = sorted(self._postings)
+            self._positions = positions
+            self._version = version
+
+    def _add(self, product_id: str, document: tuple) -> None:
+        name, description, *_ = document
+        for words, weight in ((tokenize(name), NAME_WEIGHT),
+                              (tokenize(description), DESCRIPTION_WEIGHT)):
+            for word in words:
+                postings = self._postings.setdefault(word, {})
+                postings[product_id] = postings.get(product_id, 0) + weight
+        self._documents[product_id] = document
+
+    def _remove(self, product_id: str) -> None:
+        document = self._documents.pop(product_id, None)
+        if document is None:
+            return
+        name, description, *_ = document
+        for word in set(tokenize(name)) | set(tokenize(description)):
+            postings = self._postings.get(word, {})
+            postings.pop(product_id, None)
+            if not postings:
+                self._postings.pop(word, None)
+
+    def _match_prefix(self, prefix: str) -> dict:
+        matches = {}
+        vocabulary = self._vocabulary
+        position = bisect_left(vocabulary, prefix)
+        while position < len(vocabulary) \
+                and vocabulary[position].startswith(prefix):
+            word = vocabulary[position]
+            bonus = EXACT_MATCH_BONUS if word == prefix else 1
+            for product_id, weight in self._postings[word].items():
+                matches[product_id] = max(matches.get(product_id, 0),
+                                          weight * bonus)
+            position += 1
+        return matches
+
+    def _passes_filters(self, product_id: str, query: dict) -> bool:
+        _, _, price, categories = self._documents[product_id]
+        if query['min_price'] is not None and price < query['min_price']:
+            return False
+        if query['max_price'] is not None and price > query['max_price']:
+            return False
+        if query['category'] and not any(
+                is_category_match(category_words, query['category'])
+                for category_words in categories):
+            return False
+        return True
+
+    def search(self, text: str, limit: int = 20) -> list:
+        query = parse_query(text)
+        with self._lock:
+            scores = {}
+            candidates = None
+            for word in query['words']:
+                matches = self._match_prefix(word)
+                candidates = set(matches) if candidates is None \
+                    else candidates & set(matches)
+                for product_id, score in matches.items():
+                    scores[product_id] = scores.get(product_id, 0) + score
+            if candidates is None:
+                candidates = set(self._positions)
+            found = [product_id for product_id in candidates
+                     if product_id in self._positions
+                     and self._passes_filters(product_id, query)]
+            found.sort(key=lambda product_id: (-scores.get(product_id, 0),
+                                               self._positions[product_id]))
+            return found[:limit]
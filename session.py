@@ -0,0 +1,244 @@
+import threading
+from collections import OrderedDict
+
+import redis
+import redis.asyncio as aioredis
+
+import metrics
+
+LEGACY_FIELDS = {
+    'state': '{chat_id}',
+    'email': 'email_{chat_id}',
+    'customer_id': 'customer_{chat_id}',
+}
+VERSION_FIELD = '_version'
+
+_ttl = 0
+_cache_size = 0
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def configure_sessions(ttl: int = 0, cache_size: int = 0) -> None:
+    """`ttl` — через сколько секунд без обновлений сессия чата удаляется
+    из Redis (`0` — хранить всегда), `cache_size` — сколько сессий
+    держать в памяти процесса."""
+    global _ttl, _cache_size
+    _ttl = ttl
+    _cache_size = cache_size
+    with _cache_lock:
+        while len(_cache) > _cache_size:
+            _drop(next(iter(_cache)))
+
+
+def get_session_size(fields: dict) -> int:
+    return sum(len(field.encode('utf-8')) + len(value.encode('utf-8'))
+               for field, value in fields.items())
+
+
+def _drop(chat_id: int) -> None:
+    cached = _cache.pop(chat_id, None)
+    if cached is not None:
+        metrics.SESSION_CACHE_ENTRIES.inc(-1)
+        metrics.SESSION_CACHE_BYTES.inc(-get_session_size(cached[1]))
+
+
+def _get_cached(chat_id: int):
+    with _cache_lock:
+        cached = _cache.get(chat_id)
+        if cached is None:
+            metrics.count_cache_lookup('session', 'miss')
+        else:
+            _cache.move_to_end(chat_id)
+        return cached
+
+
+def _forget(chat_id: int) -> None:
+    with _cache_lock:
+        _drop(chat_id)
+
+
+def _remember(chat_id: int, version: int, fields: dict) -> None:
+    with _cache_lock:
+        _drop(chat_id)
+        if not _cache_size or not version:
+            return
+        _cache[chat_id] = (version, dict(fields))
+        metrics.SESSION_CACHE_ENTRIES.inc()
+        metrics.SESSION_CACHE_BYTES.inc(get_session_size(fields))
+        while len(_cache) > _cache_size:
+            _drop(next(iter(_cache)))
+
+
+def _migrate_chat(database: redis.Redis, chat_id: int) -> None:
+    key = f'chat_{chat_id}'
+    legacy_keys = [legacy_key.format(chat_id=chat_id)
+                   for legacy_key in LEGACY_FIELDS.values()]
+
+    def migrate(pipeline) -> None:
+        values = pipeline.mget(legacy_keys)
+        pipeline.multi()
+        for field, value in zip(LEGACY_FIELDS, values):
+            if value is not None:
+                pipeline.hsetnx(key, field, value)
+        pipeline.hincrby(key, VERSION_FIELD, 1)
+        if _ttl:
+            pipeline.expire(key, _ttl)
+        pipeline.delete(*legacy_keys)
+
+    database.transaction(migrate, *legacy_keys)
+    _forget(chat_id)
+
+
+def migrate_legacy_sessions(database: redis.Redis,
+                            batch_size: int = 1000) -> int:
+    """Переносит старые ключи всех чатов в хэши `chat_{chat_id}` и
+    удаляет их. Поля, которые уже есть в хэше, не перезаписываются,
+    поэтому переносить можно при работающем боте. Возвращает число
+    перенесённых чатов."""
+    migrated = 0
+    for legacy_key in LEGACY_FIELDS.values():
+        prefix = legacy_key.format(chat_id='')
+        for key in database.scan_iter(match=f'{prefix}[0-9]*',
+                                      count=batch_size, _type='string'):
+            chat_id = key.decode('utf-8').removeprefix(prefix)
+            if chat_id.isdigit():
+                _migrate_chat(database, int(chat_id))
+                migrated += 1
+    return migrated
+
+
+class ChatSession:
+    """Данные одного чата, которые нужны при обработке обновления.
+
+    Все поля чата хранятся в одном хэше Redis `chat_{chat_id}` и
+    загружаются одним конвейером в начале обработки обновления, а
+    изменения записываются одной транзакцией в конце. Данные из старых
+    ключей (`{chat_id}`, `email_{chat_id}`, `customer_{chat_id}`)
+    переносятся в хэш при первой записи.
+
+    Каждая запись увеличивает номер версии сессии в хэше. Последние
+    сессии хранятся в памяти процесса: если версия в Redis не
+    изменилась, загрузка читает только её, а не весь хэш. Загрузка и
+    запись продлевают срок жизни хэша на `ttl` секунд из
+    `configure_sessions`, поэтому сессии неактивных чатов удаляются.
+    """
+
+    def __init__(self, chat_id: int, fields: dict, migrated: bool = False,
+                 version: int = 0):
+        self.chat_id = chat_id
+        self.version = version
+        self._fields = fields
+        self._changed = set(fields) if migrated else set()
+        self._migrated = migrated
+
+    @property
+    def key(self) -> str:
+        return f'chat_{self.chat_id}'
+
+    @staticmethod
+    def _queue_load(pipeline, chat_id: int, cached) -> None:
+        key = f'chat_{chat_id}'
+        if cached is not None:
+            pipeline.hget(key, VERSION_FIELD)
+        else:
+            pipeline.hgetall(key)
+            for legacy_key in LEGACY_FIELDS.values():
+                pipeline.get(legacy_key.format(chat_id=chat_id))
+        if _ttl:
+            pipeline.expire(key, _ttl)
+
+    @classmethod
+    def _from_replies(cls, chat_id: int, replies: list, cached):
+        if cached is not None:
+            version, fields = cached
+            if replies[0] is not None and int(replies[0]) == version:
+                metrics.count_cache_lookup('session', 'hit')
+                return cls(chat_id, dict(fields), version=version)
+            metrics.count_cache_lookup('session', 'stale')
+            return None
+        raw_fields, *legacy_values = replies[:len(LEGACY_FIELDS) + 1]
+        version = int(raw_fields.pop(VERSION_FIELD.encode('utf-8'), 0))
+        fields = {field.decode('utf-8'): value.decode('utf-8')
+                  for field, value in raw_fields.items()}
+        legacy_fields = {field: value.decode('utf-8')
+                         for field, value in zip(LEGACY_FIELDS, legacy_values)
+                         if value is not None and field not in fields}
+        fields.update(legacy_fields)
+        if not legacy_fields:
+            _remember(chat_id, version, fields)
+        return cls(chat_id, fields, migrated=bool(legacy_fields),
+                   version=version)
+
+    @classmethod
+    def load(cls, database: redis.Redis, chat_id: int) -> 'ChatSession':
+        cached = _get_cached(chat_id)
+        pipeline = database.pipeline(transaction=False)
+        cls._queue_load(pipeline, chat_id, cached)
+        session = cls._from_replies(chat_id, pipeline.execute(), cached)
+        if session is None:
+            pipeline = database.pipeline(transaction=False)
+            cls._queue_load(pipeline, chat_id, None)
+            session = cls._from_replies(chat_id, pipeline.execute(), None)
+        return session
+
+    def get(self, field: str, default=None):
+        return self._fields.get(field, default)
+
+    def set(self, field: str, value) -> None:
+        if self._fields.get(field) == str(value):
+            return
+        self._fields[field] = str(value)
+        self._changed.add(field)
+
+    def _queue_flush(self, pipeline) -> bool:
+        if not self._changed:
+            return False
+        changed = {field: self._fields[field] for field in self._changed}
+        pipeline.hset(self.key, mapping=changed)
+        pipeline.hincrby(self.key, VERSION_FIELD, 1)
+        if _ttl:
+            pipeline.expire(self.key, _ttl)
+        if self._migrated:
+            pipeline.delete(*(legacy_key.format(chat_id=self.chat_id)
+                              for legacy_key in LEGACY_FIELDS.values()))
+        self._changed.clear()
+        self._migrated = False
+        metrics.SESSION_BYTES.observe(get_session_size(self._fields))
+        return True
+
+    def _after_flush(self, replies: list) -> None:
+        version = int(replies[1])
+        if version == self.version + 1:
+            _remember(self.chat_id, version, self._fields)
+        else:
+            _forget(self.chat_id)
+        self.version = version
+
+    def flush(self, database: redis.Redis) -> None:
+        pipeline = database.pipeline(transaction=True)
+        if self._queue_flush(pipeline):
+            self._after_flush(pipeline.execute())
+
+
+class AsyncChatSession(ChatSession):
+
+    @classmethod
+    async def load(cls, database: aioredis.Redis,
+                   chat_id: int) -> 'AsyncChatSession':
+        cached = _get_cached(chat_id)
+        pipeline = database.pipeline(transaction=False)
+        cls._queue_load(pipeline, chat_id, cached)
+        session = cls._from_replies(chat_id, await pipeline.execute(),
+                                    cached)
+        if session is None:
+            pipeline = database.pipeline(transaction=False)
+            cls._queue_load(pipeline, chat_id, None)
+            session = cls._from_replies(chat_id, await pipeline.execute(),
+                                        None)
+        return session
+
+    async def flush(self, database: aioredis.Redis) -> None:
+        pipeline = database.pipeline(transaction=True)
+        if self._queue_flush(pipeline):
+            self._after_flush(await pipeline.execute())
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import fakeredis
+import redis
+
+import bot_async
+import metrics
+from carts import ACTIVE_CARTS_KEY
+from session import AsyncChatSession
+
+
+class BrokenPipeline:
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    async def execute(self):
+        raise redis.ConnectionError('Redis недоступен')
+
+
+class BrokenDatabase:
+
+    def pipeline(self, transaction=True):
+        return BrokenPipeline()
+
+
+def test_update_error_outside_handler_is_logged_and_counted(monkeypatch,
+                                                            caplog):
+    monkeypatch.setattr(bot_async, '_database', BrokenDatabase())
+    update = SimpleNamespace(
+        message=SimpleNamespace(text='Привет', chat_id=11),
+        callback_query=None,
+    )
+    context = SimpleNamespace(
+        bot_data={'token_manager': SimpleNamespace(get=lambda: 'token')},
+        chat_data={},
+    )
+    errors_before = metrics.UPDATE_ERRORS.totals().get(('UNKNOWN', 'bot'), 0)
+    with caplog.at_level(logging.WARNING, logger=bot_async.logger.name):
+        asyncio.run(bot_async.handle_chat_update(11, None, update, context,
+                                                 products_per_page=6))
+    assert metrics.UPDATE_ERRORS.totals()[('UNKNOWN', 'bot')] \
+        == errors_before + 1
+    assert 'Redis недоступен' in caplog.text
+    assert 11 not in bot_async._chats
+
+
+def test_changed_cart_is_tracked_for_reconcile(monkeypatch):
+    database = fakeredis.aioredis.FakeRedis()
+    monkeypatch.setattr(bot_async, '_database', database)
+    context = SimpleNamespace(
+        bot_data={'cart_reconcile_interval': 60},
+        chat_data={'session': AsyncChatSession(12, {})},
+    )
+
+    async def mark_and_read():
+        await bot_async.mark_cart_active(context)
+        return await database.zscore(ACTIVE_CARTS_KEY, 12)
+
+    assert asyncio.run(mark_and_read()) is not None
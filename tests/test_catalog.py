@@ -0,0 +1,78 @@
+import threading
+import time
+
+import fakeredis
+
+from catalog import CatalogCache
+
+
+def make_raw_product(number: int) -> dict:
+    return {
+        'id': f'product-{number}',
+        'attributes': {
+            'name': f'Рыба {number}',
+            'description': 'Свежая',
+            'price': {'USD': {'amount': 1000}},
+        },
+        'relationships': {'main_image': {'data': {'id': f'image-{number}'}}},
+    }
+
+
+def make_pages(pages: int, per_page: int = 2):
+    return [[make_raw_product(page * per_page + number)
+             for number in range(per_page)]
+            for page in range(pages)]
+
+
+def make_cache(fetch_product_pages, database=None) -> CatalogCache:
+    return CatalogCache(fetch_product_pages, lambda token: {},
+                        lambda token, product_id: 0, lambda token: {},
+                        database=database, first_page_timeout=5)
+
+
+def test_new_replica_reads_warm_shared_catalog_without_waiting():
+    database = fakeredis.FakeRedis()
+    warm_cache = make_cache(lambda token: iter(make_pages(3)), database)
+    products = warm_cache.get('token')
+    assert len(products) == 6
+
+    def fail(token):
+        raise AssertionError('каталог уже есть в Redis')
+
+    started_at = time.monotonic()
+    products = make_cache(fail, database).get('token')
+    assert time.monotonic() - started_at < 1
+    assert list(products) == list(warm_cache.get('token'))
+
+
+def test_first_page_is_served_before_the_rest_is_loaded():
+    rest_allowed = threading.Event()
+    pages = make_pages(3)
+
+    def fetch_product_pages(token):
+        yield pages[0]
+        rest_allowed.wait(5)
+        yield from pages[1:]
+
+    cache = make_cache(fetch_product_pages)
+    started_at = time.monotonic()
+    products = cache.get('token')
+    assert time.monotonic() - started_at < 1
+    assert products.page(0, 2) == ['product-0', 'product-1']
+    rest_allowed.set()
+    cache.products.refresh('token')
+    assert len(cache.get('token')) == 6
+
+
+def test_failed_first_load_does_not_wait_for_timeout():
+    def fetch_product_pages(token):
+        raise ConnectionError('Elasticpath недоступен')
+        yield
+
+    cache = make_cache(fetch_product_pages)
+    started_at = time.monotonic()
+    try:
+        cache.get('token')
+    except ConnectionError:
+        pass
+    assert time.monotonic() - started_at < 1
@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import fakeredis
+import requests
+
+import checkout
+from checkout import (CHECKOUT_DONE, CHECKOUT_FAILED, CHECKOUT_GROUP,
+                      CHECKOUT_STREAM, CheckoutWorker, CustomerCache,
+                      enqueue_checkout, get_idempotency_key)
+
+
+class FakeBot:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+
+def make_worker(database) -> tuple[CheckoutWorker, FakeBot]:
+    bot = FakeBot()
+    token_manager = SimpleNamespace(get=lambda: 'token')
+    worker = CheckoutWorker(database, bot, token_manager,
+                            CustomerCache(database), retries=1,
+                            backoff_factor=0)
+    return worker, bot
+
+
+def make_job(cart_items: str) -> dict:
+    return {'job_id': 'job', 'chat_id': '7', 'email': 'fish@example.com',
+            'customer_name': 'Иван', 'customer_id': '',
+            'cart_items': cart_items}
+
+
+def test_only_ordered_cart_items_are_deleted(monkeypatch):
+    deleted = []
+    monkeypatch.setattr(checkout, 'delete_cart_product',
+                        lambda token, chat_id, item_id, priority:
+                        deleted.append((chat_id, item_id)))
+    database = fakeredis.FakeRedis()
+    worker, bot = make_worker(database)
+    worker._finish('token', make_job('item-1,item-2'), True, 'customer')
+    assert deleted == [(7, 'item-1'), (7, 'item-2')]
+    assert bot.sent == [(7, CHECKOUT_DONE)]
+    assert not database.exists('chat_7')
+
+
+def test_already_removed_cart_item_is_skipped(monkeypatch):
+    def delete_cart_product(token, chat_id, item_id, priority):
+        response = requests.Response()
+        response.status_code = 404
+        raise requests.exceptions.HTTPError(response=response)
+
+    monkeypatch.setattr(checkout, 'delete_cart_product', delete_cart_product)
+    worker, bot = make_worker(fakeredis.FakeRedis())
+    worker._finish('token', make_job('item-1'), True, 'customer')
+    assert bot.sent == [(7, CHECKOUT_DONE)]
+
+
+def test_failed_cart_cleanup_is_reported(monkeypatch):
+    def delete_cart_product(token, chat_id, item_id, priority):
+        raise requests.exceptions.ConnectionError('Elasticpath недоступен')
+
+    monkeypatch.setattr(checkout, 'delete_cart_product', delete_cart_product)
+    worker, bot = make_worker(fakeredis.FakeRedis())
+    worker._finish('token', make_job('item-1'), True, 'customer')
+    assert bot.sent == [(7, CHECKOUT_FAILED)]
+
+
+def test_job_is_acked_after_the_reply(monkeypatch):
+    monkeypatch.setattr(checkout, 'create_customer',
+                        lambda token, name, email: 'customer')
+    monkeypatch.setattr(checkout, 'delete_cart_product',
+                        lambda token, chat_id, item_id, priority: None)
+    database = fakeredis.FakeRedis()
+    database.xgroup_create(CHECKOUT_STREAM, CHECKOUT_GROUP, id='0',
+                           mkstream=True)
+    assert enqueue_checkout(database, 7, 'fish@example.com', 'Иван',
+                            cart_items=['item-1'])
+    assert not enqueue_checkout(database, 7, 'fish@example.com', 'Иван')
+    worker, bot = make_worker(database)
+    replies = database.xreadgroup(CHECKOUT_GROUP, 'worker',
+                                  {CHECKOUT_STREAM: '>'})
+    worker.process(replies[0][1])
+    assert bot.sent == [(7, CHECKOUT_DONE)]
+    assert database.xlen(CHECKOUT_STREAM) == 0
+    assert not database.exists(get_idempotency_key(7))
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+import bot
+from outbox import Outbox
+
+
+class FakeBot:
+
+    def __init__(self, failures=()):
+        self.sent = []
+        self._failures = list(failures)
+
+    def send_message(self, chat_id, text, reply_markup=None,
+                     parse_mode=None):
+        if self._failures:
+            raise self._failures.pop(0)
+        self.sent.append((chat_id, text))
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        self.sent.append((callback_query_id, text))
+
+
+def make_context(fake_bot, outbox):
+    return SimpleNamespace(bot=fake_bot, bot_data={'outbox': outbox})
+
+
+def test_send_message_is_queued_and_delivered():
+    fake_bot = FakeBot()
+    outbox = Outbox(rate=0, chat_rate=0, workers=1)
+    bot.send_message(make_context(fake_bot, outbox), 42, 'Привет')
+    assert outbox.wait(42, timeout=5)
+    assert fake_bot.sent == [(42, 'Привет')]
+
+
+def test_put_accepts_chat_id_keyword_of_the_call():
+    fake_bot = FakeBot()
+    outbox = Outbox(rate=0, chat_rate=0, workers=1)
+    outbox.put(7, fake_bot.send_message, chat_id=7, text='Заказ оформлен')
+    assert outbox.wait(7, timeout=5)
+    assert fake_bot.sent == [(7, 'Заказ оформлен')]
+
+
+def test_calls_of_one_chat_keep_order():
+    fake_bot = FakeBot()
+    outbox = Outbox(rate=0, chat_rate=0, workers=4)
+    for number in range(5):
+        outbox.put(1, fake_bot.send_message, chat_id=1, text=str(number))
+    assert outbox.wait(1, timeout=5)
+    assert [text for _, text in fake_bot.sent] == ['0', '1', '2', '3', '4']
+
+
+def test_pending_call_with_same_key_is_replaced():
+    fake_bot = FakeBot()
+    outbox = Outbox(rate=0, chat_rate=0, workers=1)
+    context = make_context(fake_bot, outbox)
+    query = SimpleNamespace(id='q', message=SimpleNamespace(chat_id=3))
+    bot.answer_callback_query(context, query)
+    outbox.put(3, fake_bot.send_message, chat_id=3, text='old', key='menu')
+    outbox.put(3, fake_bot.send_message, chat_id=3, text='new', key='menu')
+    assert outbox.wait(3, timeout=5)
+    assert fake_bot.sent[1:] == [(3, 'new')]
+
+
+def test_retry_after_is_retried():
+    fake_bot = FakeBot(failures=[RetryAfter(0.1)])
+    outbox = Outbox(rate=0, chat_rate=0, workers=1)
+    outbox.put(5, fake_bot.send_message, chat_id=5, text='Привет')
+    assert outbox.wait(5, timeout=5)
+    assert fake_bot.sent == [(5, 'Привет')]
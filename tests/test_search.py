@@ -0,0 +1,52 @@
+from search import SearchIndex, parse_query
+
+CATEGORIES = {
+    'category-red': 'Красная рыба',
+    'category-white': 'Белая рыба',
+    'category-sea': 'Морепродукты',
+}
+PRODUCTS = {
+    'salmon': {'name': 'Лосось', 'description': 'Охлаждённый лосось',
+               'price': 12.0, 'categories': ('category-red',)},
+    'trout': {'name': 'Форель', 'description': 'Радужная форель',
+              'price': 9.0, 'categories': ('category-red',)},
+    'cod': {'name': 'Треска', 'description': 'Филе трески',
+            'price': 6.0, 'categories': ('category-white',)},
+    'shrimp': {'name': 'Креветки', 'description': 'Тигровые креветки',
+               'price': 15.0, 'categories': ('category-sea',)},
+}
+
+
+def make_index(categories: dict = CATEGORIES) -> SearchIndex:
+    index = SearchIndex()
+    index.sync(1, PRODUCTS, categories)
+    return index
+
+
+def test_parse_query_reads_category_words():
+    query = parse_query('лосось #Красная_рыба <20')
+    assert query['words'] == ['лосось']
+    assert query['category'] == ('красная', 'рыба')
+    assert query['max_price'] == 20
+
+
+def test_category_filter_matches_category_name_prefix():
+    index = make_index()
+    assert index.search('#красная') == ['salmon', 'trout']
+    assert index.search('#красная_рыба') == ['salmon', 'trout']
+    assert index.search('#рыб') == ['salmon', 'trout', 'cod']
+    assert index.search('#морепр') == ['shrimp']
+    assert index.search('#мясо') == []
+
+
+def test_category_filter_combines_with_words_and_price():
+    index = make_index()
+    assert index.search('форель #красная') == ['trout']
+    assert index.search('#рыба >8') == ['salmon', 'trout']
+
+
+def test_renamed_category_is_reindexed_on_new_version():
+    index = make_index()
+    index.sync(2, PRODUCTS, {**CATEGORIES, 'category-sea': 'Деликатесы'})
+    assert index.search('#морепродукты') == []
+    assert index.search('#деликатесы') == ['shrimp']
@@ -0,0 +1,55 @@
+import fakeredis
+import pytest
+
+from session import (ChatSession, configure_sessions,
+                     migrate_legacy_sessions)
+
+
+@pytest.fixture
+def database():
+    configure_sessions(ttl=100, cache_size=10)
+    yield fakeredis.FakeRedis()
+    configure_sessions(ttl=0, cache_size=0)
+
+
+def test_flushed_session_is_loaded_back(database):
+    session = ChatSession.load(database, 1)
+    session.set('state', 'HANDLE_MENU')
+    session.flush(database)
+    assert ChatSession.load(database, 1).get('state') == 'HANDLE_MENU'
+    assert 0 < database.ttl('chat_1') <= 100
+
+
+def test_cached_session_is_reloaded_after_foreign_write(database):
+    session = ChatSession.load(database, 2)
+    session.set('state', 'HANDLE_MENU')
+    session.flush(database)
+    database.hset('chat_2', 'state', 'HANDLE_CART')
+    database.hincrby('chat_2', '_version', 1)
+    assert ChatSession.load(database, 2).get('state') == 'HANDLE_CART'
+
+
+def test_legacy_keys_are_migrated_and_expire(database):
+    database.set('5', 'WAITING_EMAIL')
+    database.set('email_5', 'fish@example.com')
+    database.set('customer_5', 'customer-5')
+    database.hset('chat_6', 'state', 'HANDLE_CART')
+    database.set('6', 'START')
+    database.set('email_6', 'sea@example.com')
+    database.hset('customer_ids', 'fish@example.com', 'customer-5')
+    database.set('email_template', 'не сессия')
+
+    assert migrate_legacy_sessions(database) == 2
+
+    for key in ('5', 'email_5', 'customer_5', '6', 'email_6'):
+        assert not database.exists(key)
+    assert database.exists('customer_ids', 'email_template') == 2
+    session = ChatSession.load(database, 5)
+    assert session.get('state') == 'WAITING_EMAIL'
+    assert session.get('email') == 'fish@example.com'
+    assert session.get('customer_id') == 'customer-5'
+    session = ChatSession.load(database, 6)
+    assert session.get('state') == 'HANDLE_CART'
+    assert session.get('email') == 'sea@example.com'
+    assert 0 < database.ttl('chat_5') <= 100
+    assert 0 < database.ttl('chat_6') <= 100
@@ -0,0 +1,100 @@
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import redis
+from environs import Env
+from telegram import Bot
+
+logger = logging.getLogger(__name__)
+
+UPDATES_STREAM = 'telegram_updates'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def get_update_chat_id(update: dict) -> int:
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        message = update['callback_query'].get('message')
+        if message:
+            return message['chat']['id']
+        return update['callback_query']['from']['id']
+    return 0
+
+
+def get_stream_name(chat_id: int, shards: int) -> str:
+    return f'{UPDATES_STREAM}:{chat_id % shards}'
+
+
+def make_webhook_handler(database: redis.Redis, path: str, shards: int,
+                         max_stream_length: int, secret: str):
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != path:
+                self.send_response(404)
+                self.end_headers()
+                return
+            received_secret = self.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(received_secret.encode('utf-8'),
+                                       secret.encode('utf-8')):
+                self.send_response(403)
+                self.end_headers()
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            raw_update = self.rfile.read(length)
+            try:
+                chat_id = get_update_chat_id(json.loads(raw_update))
+            except (ValueError, KeyError, TypeError):
+                self.send_response(400)
+                self.end_headers()
+                return
+            database.xadd(get_stream_name(chat_id, shards),
+                          {'update': raw_update},
+                          maxlen=max_stream_length, approximate=True)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return WebhookHandler
+
+
+def main():
+    env = Env()
+    env.read_env()
+    database_password = env.str("REDIS_PASSWORD")
+    database_host = env.str("REDIS_HOST")
+    database_port = env.int("REDIS_PORT")
+    tg_token = env.str('FISH_SHOP_BOT_TG_TOKEN')
+    webhook_url = env.str('WEBHOOK_URL', None)
+    webhook_host = env.str('WEBHOOK_HOST', '0.0.0.0')
+    webhook_port = env.int('WEBHOOK_PORT', 8443)
+    webhook_path = env.str('WEBHOOK_PATH', '/telegram')
+    webhook_secret = env.str('WEBHOOK_SECRET')
+    webhook_shards = env.int('WEBHOOK_SHARDS', 4)
+    max_stream_length = env.int('WEBHOOK_STREAM_MAXLEN', 100000)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logger.setLevel(logging.INFO)
+
+    database = redis.Redis(host=database_host, port=database_port,
+                           password=database_password)
+    if webhook_url:
+        Bot(tg_token).set_webhook(url=f'{webhook_url}{webhook_path}',
+                                  secret_token=webhook_secret)
+    handler = make_webhook_handler(database, webhook_path, webhook_shards,
+                                   max_stream_length, webhook_secret)
+    server = ThreadingHTTPServer((webhook_host, webhook_port), handler)
+    logger.info('Приём обновлений через webhook запущен')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
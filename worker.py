@@ -0,0 +1,100 @@
+import json
+import logging
+import socket
+import threading
+import time
+from queue import Queue
+
+import redis
+from environs import Env
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, JobQueue
+
+from bot import add_handlers, get_database_connection, prepare_dispatcher
+from webhook import UPDATES_STREAM
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_GROUP = 'bot_workers'
+
+
+def consume_shard(database: redis.Redis, dispatcher: Dispatcher,
+                  stream: str, consumer: str, batch_size: int,
+                  backoff: float = 1) -> None:
+    try:
+        database.xgroup_create(stream, CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError:
+        pass
+    last_id = '0'
+    while True:
+        try:
+            replies = database.xreadgroup(CONSUMER_GROUP, consumer,
+                                          {stream: last_id},
+                                          count=batch_size, block=5000)
+            entries = replies[0][1] if replies else []
+            if last_id == '0' and not entries:
+                last_id = '>'
+                continue
+            for entry_id, fields in entries:
+                # Обновление подтверждается только после обработки: очередь
+                # уже упорядочена по чатам, поэтому обработка идёт здесь же
+                try:
+                    raw_update = json.loads(fields[b'update'])
+                    update = Update.de_json(raw_update, dispatcher.bot)
+                    dispatcher.process_update(update)
+                except Exception as err:
+                    logger.warning(f'Не удалось обработать обновление\n'
+                                   f'{err}\n')
+                database.xack(stream, CONSUMER_GROUP, entry_id)
+                database.xdel(stream, entry_id)
+        except Exception as err:
+            logger.warning(f'Ошибка в очереди {stream}\n{err}\n')
+            time.sleep(backoff)
+
+
+def main():
+    env = Env()
+    env.read_env()
+    products_per_page = env.int('PRODUCTS_PER_PAGE', 6)
+    database_password = env.str("REDIS_PASSWORD")
+    database_host = env.str("REDIS_HOST")
+    database_port = env.int("REDIS_PORT")
+    worker_shards = env.list('WORKER_SHARDS', subcast=int)
+    batch_size = env.int('WORKER_BATCH_SIZE', 10)
+    consumer = env.str('WORKER_NAME', socket.gethostname())
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logger.setLevel(logging.INFO)
+
+    database = get_database_connection(
+        database_password, database_host, database_port,
+        max_connections=len(worker_shards) + 4
+    )
+    tg_token = env.str('FISH_SHOP_BOT_TG_TOKEN')
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(Bot(tg_token), Queue(), workers=0,
+                            job_queue=job_queue)
+    job_queue.set_dispatcher(dispatcher)
+    prepare_dispatcher(dispatcher, env, database)
+    add_handlers(dispatcher, products_per_page, scheduled=False)
+    job_queue.start()
+
+    threads = []
+    for shard in worker_shards:
+        thread = threading.Thread(
+            target=consume_shard,
+            args=(database, dispatcher, f'{UPDATES_STREAM}:{shard}',
+                  consumer, batch_size),
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    logger.info(f'Обработчик обновлений запущен, очереди: {worker_shards}')
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()